@@ -0,0 +1,3 @@
+"""
+Benchmarks of butter's tasks against a stand-in host, see run.py.
+"""
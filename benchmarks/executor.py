@@ -0,0 +1,174 @@
+"""
+A stand-in host on this machine.
+
+install() swaps Fabric's remote command runner and its SFTP client for local
+equivalents, so butter's tasks run against directories here as if they were
+on a host. Every command and transfer is counted in the file named by the
+BUTTER_BENCH_LOG environment variable, as a line of the number of commands
+and the number of bytes it sent and received. The stub ssh in bin/ counts
+the commands it runs there too, so forked hosts and the subprocesses butter
+starts itself all add up in one place.
+"""
+from __future__ import with_statement
+from fabric.api import env, quiet as quiet_manager, \
+    warn_only as warn_only_manager
+from fabric.state import output
+from fabric.utils import error
+import fabric.operations
+import fabric.sftp
+import os
+import shutil
+import subprocess
+
+def record(commands=0, transferred=0):
+    """
+    Count `commands` remote commands and `transferred` bytes
+    """
+    with open(os.environ['BUTTER_BENCH_LOG'], 'a') as log:
+        log.write('%d %d\n' % (commands, transferred))
+
+def totals(path):
+    """
+    Returns the number of commands and bytes counted in the log at `path`
+    """
+    commands = transferred = 0
+    if os.path.exists(path):
+        with open(path) as log:
+            for line in log:
+                counts = line.split()
+                commands += int(counts[0])
+                transferred += int(counts[1])
+    return commands, transferred
+
+def install():
+    fabric.operations._run_command = run_command
+    fabric.operations.SFTP = LocalSFTP
+
+def run_command(command, shell=True, pty=True, combine_stderr=None,
+                sudo=False, user=None, quiet=False, warn_only=False,
+                stdout=None, stderr=None, group=None, timeout=None,
+                shell_escape=None, capture_buffer_size=None):
+    """
+    Runs `command` here the way fabric.operations._run_command runs it on a
+    host. sudo is ignored, everything runs as the current user.
+    """
+    manager = fabric.operations._noop
+    if warn_only:
+        manager = warn_only_manager
+    if quiet:
+        manager = quiet_manager
+    with manager():
+        if shell_escape is None:
+            shell_escape = env.get('shell_escape', True)
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        wrapped_command = fabric.operations._shell_wrap(
+            fabric.operations._prefix_env_vars(
+                fabric.operations._prefix_commands(command, 'remote')),
+            shell_escape, shell, None)
+        which = sudo and 'sudo' or 'run'
+        if output.running:
+            print('[%s] %s: %s' % (env.host_string, which, command))
+
+        process = subprocess.Popen(
+            wrapped_command, shell=True, stdout=subprocess.PIPE,
+            stderr=combine_stderr and subprocess.STDOUT or subprocess.PIPE)
+        out, err = process.communicate()
+        record(1, len(wrapped_command) + len(out) + len(err or b''))
+        out = out.decode('utf-8', 'replace')
+        err = (err or b'').decode('utf-8', 'replace')
+        if output.stdout:
+            for line in out.splitlines():
+                print('[%s] out: %s' % (env.host_string, line))
+
+        out = fabric.operations._AttributeString(out.strip())
+        err = fabric.operations._AttributeString(err.strip())
+        out.failed = False
+        out.command = command
+        out.real_command = wrapped_command
+        if process.returncode not in env.ok_ret_codes:
+            out.failed = True
+            msg = '%s() received nonzero return code %s while executing' % (
+                which, process.returncode)
+            if env.warn_only:
+                msg += " '%s'!" % command
+            else:
+                msg += '!\n\nRequested: %s\nExecuted: %s' % (command,
+                                                             wrapped_command)
+            error(message=msg, stdout=out, stderr=err)
+        out.return_code = process.returncode
+        out.succeeded = not out.failed
+        out.stderr = err
+        return out
+
+class LocalSFTP(fabric.sftp.SFTP):
+    """
+    Fabric's SFTP helper, on top of LocalClient rather than a connection
+    """
+    def __init__(self, host_string):
+        self.ftp = LocalClient()
+
+class LocalClient(object):
+    """
+    The part of paramiko's SFTPClient that fabric.sftp uses, on this machine
+    """
+
+    def normalize(self, path):
+        if path == '.':
+            path = os.path.expanduser('~')
+        return os.path.abspath(path)
+
+    def getcwd(self):
+        return None
+
+    def stat(self, path):
+        return self._call(os.stat, path)
+
+    def lstat(self, path):
+        return self._call(os.lstat, path)
+
+    def listdir(self, path='.'):
+        return self._call(os.listdir, path)
+
+    def mkdir(self, path, mode=511):
+        self._call(os.mkdir, path, mode)
+
+    def chmod(self, path, mode):
+        self._call(os.chmod, path, mode)
+
+    def rename(self, oldpath, newpath):
+        self._call(os.rename, oldpath, newpath)
+
+    def remove(self, path):
+        self._call(os.remove, path)
+
+    def put(self, localpath, remotepath, callback=None, confirm=True):
+        shutil.copyfile(localpath, remotepath)
+        record(0, os.path.getsize(remotepath))
+        return self.stat(remotepath)
+
+    def putfo(self, fl, remotepath, file_size=0, callback=None,
+              confirm=True):
+        with open(remotepath, 'wb') as remote:
+            shutil.copyfileobj(fl, remote)
+        record(0, os.path.getsize(remotepath))
+        return self.stat(remotepath)
+
+    def get(self, remotepath, localpath, callback=None):
+        shutil.copyfile(remotepath, localpath)
+        record(0, os.path.getsize(localpath))
+
+    def getfo(self, remotepath, fl, callback=None):
+        with open(remotepath, 'rb') as remote:
+            shutil.copyfileobj(remote, fl)
+        record(0, os.path.getsize(remotepath))
+
+    def close(self):
+        pass
+
+    def _call(self, function, *args):
+        # paramiko raises IOError, which is what fabric.sftp catches.
+        try:
+            return function(*args)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, args[0])
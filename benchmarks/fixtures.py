@@ -0,0 +1,162 @@
+"""
+The repositories, sites, apps and databases the benchmarks run against.
+
+Contents are generated from fixed seeds, so two runs with the same sizes
+build the same fixtures.
+"""
+from __future__ import with_statement
+from time import time
+import os
+import random
+import shutil
+import string
+import subprocess
+
+VENV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_venv')
+
+def git(cwd, *args):
+    """
+    Runs git in `cwd` and returns its output
+    """
+    command = ['git', '-c', 'user.name=butter', '-c',
+               'user.email=butter@localhost'] + list(args)
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE)
+    out = process.communicate()[0].decode('utf-8')
+    if process.returncode != 0:
+        raise RuntimeError('%s failed in %s' % (' '.join(command), cwd))
+    return out.strip()
+
+def init(path):
+    git(os.path.dirname(path), 'init', '-q', path)
+    git(path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+
+def text(seed, size):
+    """
+    Returns `size` bytes of text, the same for the same `seed`
+    """
+    rand = random.Random(seed)
+    letters = string.ascii_lowercase + '     \n'
+    return ''.join([rand.choice(letters) for i in range(size)])
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+def drupal_repo(path, files, size):
+    """
+    Creates a Drupal site repository at `path` with `files` files of `size`
+    bytes, 100 to a directory. Its second commit changes one file in a
+    hundred and adds one. Returns the hashes of both commits.
+    """
+    init(path)
+    write('%s/public/index.php' % path, '<?php\n')
+    write('%s/public/robots.txt' % path, 'User-agent: *\n')
+    write('%s/public/sites/default/settings.staging.php' % path,
+          "<?php\n$databases['default']['default'] = array(\n"
+          "  'database' => '%%DB_DB%%',\n  'username' => '%%DB_USER%%',\n"
+          "  'password' => '%%DB_PW%%',\n  'host' => '%%DB_HOST%%',\n);\n")
+    for i in range(files):
+        write('%s/public/modules/m%03d/f%05d.php' % (path, i // 100, i),
+              text(i, size))
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Initial version')
+    first = git(path, 'rev-parse', 'HEAD')
+
+    for i in range(0, files, 100):
+        write('%s/public/modules/m%03d/f%05d.php' % (path, i // 100, i),
+              text(-i - 1, size))
+    write('%s/public/modules/new/new.php' % path, text('new', size))
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Second version')
+    return [first, git(path, 'rev-parse', 'HEAD')]
+
+def drupal_site(path, origin):
+    """
+    Creates an empty site directory at `path`, as drupal.setup_env would
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    for name in ('changesets', 'files', 'private'):
+        os.makedirs('%s/%s' % (path, name))
+    git(path, 'clone', '-q', origin, 'private/repo')
+
+def changesets(path, count, files):
+    """
+    Creates a site at `path` with `count` changesets of `files` files, a day
+    apart and the newest live
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    now = time()
+    for i in range(count):
+        changeset = '%s/changesets/%040x' % (path, i)
+        for j in range(files):
+            write('%s/public/f%05d.php' % (changeset, j), text(j, 512))
+        age = now - (count - i) * 86400
+        os.utime(changeset, (age, age))
+    os.symlink('%s/changesets/%040x/public' % (path, count - 1),
+               '%s/current' % path)
+
+def django_repo(path, files):
+    """
+    Creates a Django app repository at `path` with `files` static files.
+    Its second commit changes a static file and adds a migration. Returns
+    the hashes of both commits.
+    """
+    init(path)
+    write('%s/manage.py' % path, '#!/usr/bin/env python\n')
+    write('%s/requirements/bench.txt' % path, 'Django==1.4.22\nSouth==1.0\n')
+    write('%s/bench/__init__.py' % path, '')
+    write('%s/bench/migrations/0001_initial.py' % path, '')
+    for i in range(files):
+        write('%s/bench/static/bench/s%05d.css' % (path, i), text(i, 1024))
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Initial version')
+    first = git(path, 'rev-parse', 'HEAD')
+
+    write('%s/bench/static/bench/s%05d.css' % (path, 0), text(-1, 1024))
+    write('%s/bench/migrations/0002_change.py' % path, '')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Second version')
+    return [first, git(path, 'rev-parse', 'HEAD')]
+
+def django_app(path, origin):
+    """
+    Installs the app of `origin` at `path`, as django.install would, with a
+    virtualenv of the stubs in stub_venv/
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs('%s/log' % path)
+    git(path, 'clone', '-q', origin, 'app')
+    shutil.copytree(VENV, '%s/venv/bin' % path)
+    write('%s/venv/bin/activate' % path,
+          'PATH="%s/venv/bin:$PATH"; export PATH\n' % path)
+
+def databases(root, tables, rows):
+    """
+    Creates the databases of the stub mysql under `root`: bench_src with
+    `tables` tables of up to `rows` rows, and bench_dst with the same tables,
+    every other one with different rows, and two tables of its own
+    """
+    for db in ('bench_src', 'bench_dst'):
+        if os.path.exists('%s/mysql/%s' % (root, db)):
+            shutil.rmtree('%s/mysql/%s' % (root, db))
+    for i in range(tables):
+        name = 'table_%03d' % i
+        count = max(1, rows // (i + 1))
+        _table(root, 'bench_src', name, i, count)
+        _table(root, 'bench_dst', name, i % 2 and -i - 1 or i, count)
+    for name in ('stale_1', 'stale_2'):
+        _table(root, 'bench_dst', name, name, 10)
+
+def _table(root, db, name, seed, rows):
+    rand = random.Random(seed)
+    lines = ['CREATE TABLE `%s` (id int, value text);\n' % name]
+    for i in range(rows):
+        lines.append("INSERT INTO `%s` VALUES (%d, '%s');\n" % (
+            name, i, ''.join([rand.choice(string.ascii_letters)
+                              for j in range(100)])))
+    write('%s/mysql/%s/%s' % (root, db, name), ''.join(lines))
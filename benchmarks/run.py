@@ -0,0 +1,287 @@
+"""
+Times butter's tasks against a stand-in host on this machine.
+
+    python benchmarks/run.py [--tasks push,clean] [--repeat 3] [--save]
+
+Each task runs in a forked process against fresh fixtures, with remote
+commands and transfers going through the local executor of executor.py,
+ssh, mysql and the app servers replaced by the stubs in bin/, and the python
+and pip of the Django app's virtualenv by those in stub_venv/. For every task
+the wall time (the best of --repeat runs), the number of remote commands and
+the bytes they sent and received are reported, and compared with a baseline
+saved by an earlier run with --save. Commands are expected to stay the same;
+a task that runs more of them, or that is slower or transfers more than the
+baseline by more than --tolerance, is a regression and makes the run fail.
+"""
+from __future__ import with_statement
+import argparse
+import getpass
+import grp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from time import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fabric.api import env, execute, settings, task
+import fabric.state
+from benchmarks import executor, fixtures
+from butter import deploy, django, drupal, sync
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+def push(root, options):
+    """
+    drupal.push of a new commit to a site that has the previous one live
+    """
+    if not os.path.exists('%s/drupal' % root):
+        fixtures.drupal_repo('%s/drupal' % root, options.files,
+                             options.file_size)
+    first = fixtures.git('%s/drupal' % root, 'rev-list', 'HEAD').split()[-1]
+    fixtures.drupal_site('%s/site' % root, '%s/drupal' % root)
+    with settings(**_drupal_env(root)):
+        execute(drupal.push, first, hosts=['localhost'])
+    yield
+    with settings(**_drupal_env(root)):
+        execute(drupal.push, 'master', hosts=['localhost'])
+
+def clean(root, options):
+    """
+    deploy.clean of a site with old changesets to retire
+    """
+    fixtures.changesets('%s/site' % root, options.changesets, 10)
+    yield
+    with settings(**_drupal_env(root)):
+        execute(deploy.clean, hosts=['localhost'])
+
+def sync_db(root, options):
+    """
+    sync.db with the stream engine between two databases on the host
+    """
+    fixtures.databases(root, options.tables, options.rows)
+    for name in ('bench_src', 'bench_dst'):
+        fabric.state.commands[name] = _db_env(name)
+    yield
+    execute(sync.db, 'bench_src', 'bench_dst', engine='stream')
+
+def django_deploy(root, options):
+    """
+    django.deploy of a new commit to an app that has the previous one
+    deployed
+    """
+    if not os.path.exists('%s/django' % root):
+        fixtures.django_repo('%s/django' % root, options.files // 10)
+    first = fixtures.git('%s/django' % root, 'rev-list', 'HEAD').split()[-1]
+    fixtures.django_app('%s/app' % root, '%s/django' % root)
+    with settings(**_django_env(root)):
+        execute(django.deploy, first, hosts=['localhost'])
+    yield
+    with settings(**_django_env(root)):
+        execute(django.deploy, hosts=['localhost'])
+
+# Benchmarked tasks: generators that set up their fixtures, yield, and then
+# run the task.
+tasks = [('push', push), ('clean', clean), ('sync_db', sync_db),
+         ('django_deploy', django_deploy)]
+
+def _drupal_env(root):
+    return {'repo_type': 'git', 'repo_url': '%s/drupal' % root,
+            'host_site_path': '%s/site' % root, 'host_type': 'staging',
+            'user': getpass.getuser(),
+            'host_webserver_user': grp.getgrgid(os.getgid()).gr_name}
+
+def _django_env(root):
+    return {'app_path': '%s/app' % root, 'host_type': 'bench',
+            'repo_uri': '%s/django' % root,
+            'django_settings_module': 'bench.settings',
+            'health_check_url': 'http://localhost/',
+            'available_environments': []}
+
+def _db_env(name):
+    def environment():
+        env.hosts = ['localhost']
+        env.db_db = name
+        env.db_user = 'bench'
+        env.db_pw = 'bench'
+    environment.__name__ = name
+    return task(environment)
+
+def measure(name, function, root, options):
+    """
+    Run a benchmarked task in a forked process. Returns its seconds,
+    commands and bytes, or None if it failed.
+    """
+    log = '%s/%s.log' % (root, name)
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 1
+        try:
+            # Everything the task and its subprocesses print goes to the log.
+            out = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            os.dup2(out, 1)
+            os.dup2(out, 2)
+            steps = function(root, options)
+            next(steps)
+            counts = os.environ['BUTTER_BENCH_LOG']
+            if os.path.exists(counts):
+                os.remove(counts)
+            start = time()
+            for step in steps:
+                pass
+            seconds = time() - start
+            commands, transferred = executor.totals(counts)
+            os.write(write_end, json.dumps({
+                'seconds': seconds, 'commands': commands,
+                'bytes': transferred}).encode('utf-8'))
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+    os.close(write_end)
+    result = b''
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        result += chunk
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    if not result:
+        with open(log) as f:
+            print('+ %s failed, the end of its output:' % name)
+            print(''.join(f.readlines()[-20:]))
+        return None
+    return json.loads(result.decode('utf-8'))
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline. Returns the regressions.
+    """
+    regressions = []
+    print('  %-15s %18s %16s %20s' % ('task', 'seconds', 'commands', 'bytes'))
+    for name, result in results:
+        before = baseline.get(name)
+        columns = []
+        for metric, format in (('seconds', '%.2f'), ('commands', '%d'),
+                               ('bytes', '%d')):
+            column = format % result[metric]
+            if before:
+                change = (result[metric] - before[metric]) / \
+                    float(before[metric] or 1)
+                column += ' (%+.0f%%)' % (change * 100)
+                limit = metric != 'commands' and tolerance or 0
+                # Differences of a few hundredths of a second are noise.
+                noise = metric == 'seconds' and \
+                    result[metric] - before[metric] < 0.1
+                if change > limit and not noise:
+                    regressions.append('%s %s' % (name, metric))
+            columns.append(column)
+        print('  %-15s %18s %16s %20s' % tuple([name] + columns))
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmark butter against a stand-in host.')
+    parser.add_argument('--tasks', default=','.join([name for name, function
+                                                     in tasks]),
+                        help='comma separated tasks to run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each task, the fastest one counts')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='files in the fake repository')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='size of each file in bytes')
+    parser.add_argument('--changesets', type=int, default=20,
+                        help='changesets on the site deploy.clean cleans')
+    parser.add_argument('--tables', type=int, default=20,
+                        help='tables in the synced database')
+    parser.add_argument('--rows', type=int, default=2000,
+                        help='rows in its largest table')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline to compare with (%(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown or extra bytes tolerated, 0.2 by '
+                             'default')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the fixtures and logs')
+    options = parser.parse_args(args)
+    sizes = dict([(key, getattr(options, key)) for key in
+                  ('files', 'file_size', 'changesets', 'tables', 'rows')])
+
+    selected = options.tasks.split(',')
+    unknown = [name for name in selected if name not in dict(tasks)]
+    if unknown:
+        parser.error('unknown tasks: %s' % ', '.join(unknown))
+
+    root = os.path.realpath(tempfile.mkdtemp(prefix='butter-bench-'))
+    # Caches in ~/.butter are kept with the fixtures.
+    os.environ['HOME'] = '%s/home' % root
+    os.makedirs(os.environ['HOME'])
+    os.environ['PATH'] = '%s/bin:%s' % (HERE, os.environ['PATH'])
+    os.environ['BUTTER_BENCH_ROOT'] = root
+    os.environ['BUTTER_BENCH_LOG'] = '%s/counts' % root
+    executor.install()
+    # Keep the PATH above, a login shell could reset it.
+    env.shell = '/bin/bash -c'
+
+    results = []
+    failed = False
+    try:
+        for name, function in tasks:
+            if name not in selected:
+                continue
+            print('+ Running %s %d times' % (name, options.repeat))
+            runs = [measure(name, function, root, options)
+                    for i in range(options.repeat)]
+            if None in runs:
+                failed = True
+                continue
+            result = runs[-1]
+            result['seconds'] = min([run['seconds'] for run in runs])
+            results.append((name, result))
+    finally:
+        if options.keep:
+            print('+ Fixtures and logs are in %s' % root)
+        else:
+            shutil.rmtree(root)
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('sizes') != sizes:
+            print('+ The baseline was saved with other sizes, ignoring it')
+            baseline = {}
+    else:
+        print('+ No baseline at %s, run with --save to record one'
+              % options.baseline)
+    print('+ Results')
+    regressions = compare(results, baseline.get('tasks', {}),
+                          options.tolerance)
+
+    if options.save:
+        saved = dict(baseline.get('tasks', {}))
+        saved.update(dict(results))
+        with open(options.baseline, 'w') as f:
+            json.dump({'sizes': sizes, 'tasks': saved}, f, indent=1,
+                      sort_keys=True)
+        print('+ Baseline saved to %s' % options.baseline)
+    elif regressions:
+        print('+ Regressions: %s' % ', '.join(regressions))
+        return 1
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
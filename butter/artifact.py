@@ -0,0 +1,153 @@
+"""
+Build-once release artifacts.
+
+With `env.changeset_mode = 'artifact'` a ref is resolved and built into a
+compressed tarball once, on this machine or on `env.artifact_build_host`,
+instead of on every host. The tarball is uploaded to the hosts, which only
+verify and unpack it, so they don't touch the repository at all.
+
+Tarballs are cached by commit in `env.artifact_cache` (~/.butter/artifacts by
+default) on the machine that builds them, and here.
+"""
+from __future__ import with_statement
+from fabric.api import env, abort, hide, settings
+from fabric.operations import run, local, put, get
+from butter import git, profile
+from butter.batch import batched
+import hashlib
+import os
+import tarfile
+
+# Built artifacts by ref: (parsed ref, local path, sha256).
+_artifacts = {}
+
+def check_commit(ref):
+    print('+ Ensuring %s exists' % ref)
+    return build(ref)[0]
+
+def build(ref):
+    """
+    Resolve `ref` and build its tarball unless it is cached. Returns the
+    parsed ref, the path of the tarball here and its sha256.
+    """
+    if ref in _artifacts:
+        return _artifacts[ref]
+    cache = getattr(env, 'artifact_cache', '~/.butter/artifacts')
+    build_host = getattr(env, 'artifact_build_host', None)
+    repo = '%s/repo' % cache
+    shell = lambda command: _shell(build_host, command)
+
+    if env.repo_type == 'git':
+        parsed_ref = shell(
+            'mkdir -p %s && if ! [ -d %s ]; then '
+            'git clone --quiet %s %s; fi && '
+            'cd %s && %s' % (cache, repo, env.repo_url, repo, repo,
+                             git.fetch_sh(ref)))
+    else:
+        parsed_ref = shell(
+            'mkdir -p %s && if ! [ -d %s ]; then '
+            'hg clone --quiet -U %s %s; fi && '
+            'cd %s && hg pull --quiet && hg identify --id -r %s'
+            % (cache, repo, env.repo_url, repo, repo, ref))
+    if parsed_ref.failed:
+        abort('Commit %s doesnt exist' % ref)
+    parsed_ref = parsed_ref.strip()
+
+    tarball = '%s/%s.tar.gz' % (cache, parsed_ref)
+    local_tarball = os.path.expanduser(tarball)
+    if os.path.exists(local_tarball):
+        print('+ Using the cached artifact of %s' % parsed_ref)
+    else:
+        print('+ Building the artifact of %s%s' % (
+            parsed_ref, build_host and ' on %s' % build_host or ''))
+        if env.repo_type == 'git':
+            export = ('cd %s && git reset --quiet --hard %s && '
+                      'git submodule --quiet update --init --recursive && '
+                      "tar czf %s.tmp --exclude='./.git*' ."
+                      % (repo, parsed_ref, tarball))
+        else:
+            export = ('rm -rf %s.d && hg archive -R %s -r %s %s.d && '
+                      "tar czf %s.tmp --exclude='./.hg*' -C %s.d . && "
+                      'rm -rf %s.d' % ((tarball, repo, parsed_ref) +
+                                       (tarball,) * 4))
+        if shell('%s && mv %s.tmp %s' % (export, tarball, tarball)).failed:
+            abort('Could not build the artifact of %s' % parsed_ref)
+        if build_host:
+            if not os.path.isdir(os.path.dirname(local_tarball)):
+                os.makedirs(os.path.dirname(local_tarball))
+            with settings(host_string=build_host):
+                get(tarball, local_tarball + '.tmp')
+            os.rename(local_tarball + '.tmp', local_tarball)
+
+    _artifacts[ref] = (parsed_ref, local_tarball, _sha256(local_tarball))
+    _artifacts[parsed_ref] = _artifacts[ref]
+    return _artifacts[ref]
+
+def read_file(parsed_ref, path):
+    """
+    Returns the contents of `path` at `parsed_ref`, or None if it does not
+    exist.
+    """
+    archive = tarfile.open(build(parsed_ref)[1])
+    try:
+        for name in (path, './' + path):
+            try:
+                member = archive.extractfile(name)
+            except KeyError:
+                continue
+            if member is not None:
+                return member.read()
+        return None
+    finally:
+        archive.close()
+
+def upload(parsed_ref):
+    """
+    Upload the tarball of `parsed_ref` to private/artifacts on the current
+    host, unless it is there already. Returns its path on the host.
+    """
+    parsed_ref, tarball, checksum = build(parsed_ref)
+    path = '%s/private/artifacts/%s.tar.gz' % (env.host_site_path, parsed_ref)
+    with profile.stage('upload'):
+        with settings(hide('everything'), warn_only=True):
+            uploaded = run('mkdir -p %s/private/artifacts && '
+                           'sha256sum %s 2>/dev/null' % (env.host_site_path,
+                                                         path))
+        if uploaded.split(' ')[0] == checksum:
+            print('+ %s is already uploaded' % parsed_ref)
+        else:
+            print('+ Uploading %s (%.1fMB)' % (
+                parsed_ref, os.path.getsize(tarball) / 1024.0 / 1024))
+            with hide('running'):
+                put(tarball, path)
+    return path
+
+def checkout(parsed_ref, batch=None):
+    """
+    Build changesets/<parsed_ref> from the uploaded tarball, after checking
+    it. Older tarballs are removed from the host.
+    """
+    path = upload(parsed_ref)
+    checksum = build(parsed_ref)[2]
+    with batched(batch) as b:
+        b.add('Unpacking %s into changesets' % parsed_ref,
+              "echo '%s  %s' | sha256sum -c --quiet && "
+              'mkdir changesets/%s && tar xzpf %s -C changesets/%s && '
+              "find private/artifacts -type f ! -name '%s.tar.gz' -delete"
+              % (checksum, path, parsed_ref, path, parsed_ref, parsed_ref),
+              cwd=env.host_site_path, stage='checkout')
+
+def _shell(build_host, command):
+    if build_host:
+        with settings(hide('running', 'stdout'), host_string=build_host,
+                      warn_only=True):
+            return run(command)
+    with settings(hide('running'), warn_only=True):
+        return local(command, capture=True)
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as tarball:
+        for chunk in iter(lambda: tarball.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
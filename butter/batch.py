@@ -0,0 +1,150 @@
+from __future__ import with_statement
+from contextlib import contextmanager
+from fabric.api import env, abort, hide, settings
+from fabric.operations import run
+from butter import profile
+import base64
+
+MARKER = '__butter_step__'
+
+class Batch(object):
+    """
+    A queue of shell commands that run on the current host as one script, in
+    a single round trip.
+
+    Each step runs in its own subshell, so a `cd` does not leak into the next
+    step. The script stops at the first failing step unless that step was
+    added with `warn_only=True`. Every step that ran is reported with its exit
+    status and duration; its output is printed if it failed or was added with
+    `show=True`.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.results = []
+
+    def add(self, label, command, cwd=None, warn_only=False, show=False,
+            stage=None):
+        """
+        Queue `command`. `stage` names the pipeline stage the step belongs to
+        in the results, and defaults to `label`.
+        """
+        if cwd:
+            command = 'cd %s && %s' % (cwd, command)
+        self.steps.append({'label': label, 'command': command,
+                           'warn_only': warn_only, 'show': show,
+                           'stage': stage or label})
+
+    def script(self):
+        lines = []
+        for i, step in enumerate(self.steps):
+            lines.append('echo %s %d $(date +%%s%%N)' % (MARKER, i))
+            lines.append('(%s\n) 2>&1' % step['command'])
+            lines.append('rc=$?; echo; echo %s %d $rc $(date +%%s%%N)' %
+                         (MARKER, i))
+            if not step['warn_only']:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        # One compound command, so a failing `cd` Fabric puts ahead of it
+        # stops all of it.
+        return '{\n%s\n}' % '\n'.join(lines)
+
+    def run(self):
+        """
+        Run the queued steps and return a list of results for the steps that
+        ran: dictionaries with the `label`, `stage`, exit `status`, `output`
+        and `duration` in seconds (None if the host can't tell) of each step.
+        """
+        if not self.steps:
+            return []
+        with profile.stage('batch'):
+            with settings(hide('running', 'stdout', 'warnings'),
+                          warn_only=True):
+                out = run(self.script())
+        self.results = self._parse(out)
+        self.steps = []
+        profile.add_steps(self.results)
+
+        failed = None
+        for result in self.results:
+            took = ''
+            if result['duration'] is not None:
+                took = ' (%.1fs)' % result['duration']
+            if result['status'] == 0:
+                print('+ %s%s' % (result['label'], took))
+            else:
+                print('+ %s failed with status %s%s' % (result['label'],
+                                                        result['status'], took))
+                if not result['warn_only']:
+                    failed = result['label']
+            if result['output'] and (result['show'] or result['status'] != 0):
+                print(result['output'])
+        if failed:
+            abort('%s failed on %s' % (failed, env.host_string))
+        if out.failed and not [result for result in self.results
+                               if result['status'] != 0]:
+            # Something outside of the steps failed, e.g. the login shell.
+            if out.strip():
+                print(out)
+            abort('The batch failed on %s with status %s' % (
+                env.host_string, out.return_code))
+        return self.results
+
+    def _parse(self, out):
+        results = []
+        current = None
+        lines = []
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) in (3, 4) and fields[0] == MARKER:
+                if len(fields) == 3:
+                    current = int(fields[1])
+                    started = fields[2]
+                    lines = []
+                elif current is not None:
+                    # Drop the blank line echoed ahead of the end marker.
+                    results.append(self._result(current, int(fields[2]),
+                                                lines[:-1], started,
+                                                fields[3]))
+                    current = None
+            elif current is not None:
+                lines.append(line)
+        if current is not None:
+            # The script died in the middle of a step, e.g. the connection
+            # dropped.
+            result = self._result(current, -1, lines, started, None)
+            result['warn_only'] = False
+            results.append(result)
+        return results
+
+    def _result(self, index, status, lines, started, ended):
+        result = dict(self.steps[index])
+        del result['command']
+        result['status'] = status
+        result['output'] = '\n'.join(lines).rstrip()
+        # date +%N is not supported everywhere.
+        if started.isdigit() and ended and ended.isdigit():
+            result['duration'] = (int(ended) - int(started)) / 1e9
+        else:
+            result['duration'] = None
+        return result
+
+@contextmanager
+def batched(batch=None):
+    """
+    Yield `batch` to queue commands on, or a new Batch that is run as soon as
+    the block exits when no batch was given.
+    """
+    if batch is not None:
+        yield batch
+    else:
+        batch = Batch()
+        yield batch
+        batch.run()
+
+def write_command(path, content, append=False):
+    """
+    Returns a shell command that writes `content` to `path`. The content is
+    base64 encoded, so it survives the shell quoting of a batch intact.
+    """
+    return 'echo %s | base64 -d %s %s' % (base64.b64encode(content),
+                                          append and '>>' or '>', path)
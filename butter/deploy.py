@@ -1,47 +1,211 @@
 from __future__ import with_statement
 from fabric.operations import run
-from fabric.api import task, env, cd, hide
-from fabric.contrib import files
-from time import gmtime, strftime
+from fabric.api import task, env, cd, hide, abort
+from butter.batch import batched, write_command
+from butter import profile
+from collections import OrderedDict
+from contextlib import contextmanager
+from pipes import quote
+from time import gmtime, strftime, time
+import getpass
+import json
 import os
+import re
+
+# Append-only journal of deployments, one JSON record per line.
+JOURNAL = 'DEPLOYMENTS.jsonl'
 
 @task
-def log():
+def log(last=10, ref=None, since=None, until=None):
     """
-    Tail a the deployment log of a host
+    Show the last deployments of a host
+
+    Only the `last` matching records are read from the host. They can be
+    narrowed down to a `ref`, or to the ones started `since` and/or `until` a
+    date, given as YYYY-MM-DD.
     """
     print('+ Reading deployment log...')
+    # Records start with {"start": "<date>, see mark().
+    pipeline = ['cat %s' % JOURNAL]
+    if ref:
+        pipeline.append('grep -F -e %s -e %s' % (quote('"ref": "%s' % ref),
+                                                 quote('"requested": "%s' %
+                                                       ref)))
+    for date, operator in ((since, '>='), (until, '<=')):
+        if date:
+            if not re.match(r'^\d{4}(-\d\d){0,2}$', date):
+                abort('Dates must be given as YYYY-MM-DD, not %s' % date)
+            pipeline.append("awk 'substr($0, 12, %d) %s \"%s\"'" %
+                            (len(date), operator, date))
+    pipeline.append('tail -n %d' % int(last))
     with cd(env.host_site_path):
         with hide('running', 'stdout'):
-            out = run('cat DEPLOYMENTS')
-            print(out)
+            out = run('if [ -f %s ]; then %s; else tail -n %d DEPLOYMENTS; fi'
+                      % (JOURNAL, ' | '.join(pipeline), int(last)))
+
+    durations = []
+    for line in out.splitlines():
+        try:
+            record = json.loads(line, object_pairs_hook=OrderedDict)
+        except ValueError:
+            # A line of the DEPLOYMENTS file that preceded the journal.
+            print(line)
+            continue
+        if record['outcome'] == 'success':
+            durations.append(record['duration'])
+        print('%s %-12s %-10s %-8s %6.1fs  %s' % (
+            record['start'], record['ref'][:12], record['user'],
+            record['outcome'], record['duration'], ' '.join(
+                ['%s=%.1fs' % stage for stage in record['stages'].items()])))
+    if durations:
+        print('+ Successful deployments took %.1fs on average' %
+              (sum(durations) / len(durations)))
+
+def start(ref):
+    """
+    Start timing a deployment of `ref`. Returns the record mark() writes to
+    the journal.
+    """
+    return {'ref': ref, 'parsed_ref': None, 'user': _user(),
+            'start': time(), 'stages': OrderedDict()}
+
+@contextmanager
+def stage(record, name):
+    """
+    Time a stage of a deployment into `record`, and into the profile
+    """
+    started = time()
+    try:
+        with profile.stage(name):
+            yield
+    finally:
+        add_stage(record, name, time() - started)
 
-def mark(parsed_ref):
+def add_stage(record, name, duration):
+    record['stages'][name] = round(record['stages'].get(name, 0) + duration,
+                                   3)
+
+def add_steps(record, results):
+    """
+    Add the durations of the steps run by a Batch to `record`, by stage
+    """
+    for result in results:
+        if result['duration'] is not None:
+            add_stage(record, result['stage'], result['duration'])
+
+@contextmanager
+def journal(record, mark_success=True):
+    """
+    Write `record` to the journal when the block exits, as failed if the
+    block raised, or as successful if `mark_success`.
+    """
+    succeeded = False
+    try:
+        yield record
+        succeeded = True
+    finally:
+        if not succeeded:
+            try:
+                mark(record['parsed_ref'] or record['ref'], record=record,
+                     outcome='failed')
+            except (SystemExit, Exception):
+                print('+ Could not log the failed deployment')
+        elif mark_success:
+            mark(record['parsed_ref'] or record['ref'], record=record)
+
+def mark(parsed_ref, batch=None, record=None, outcome='success'):
     """
     Mark a deployment
     """
-    from time import gmtime, strftime
-    print('+ Logging deployment')
-    with cd(env.host_site_path):
-        with hide('running', 'stdout'):
-            if not files.exists('DEPLOYMENTS'):
-                print('+ No DEPLOYMENTS file found. Creating one.')
-                run('touch DEPLOYMENTS');
-            date= strftime("%Y.%m.%d at %H:%M:%SUTC", gmtime())
-            run('echo "%s by %s: %s" >> DEPLOYMENTS' % (date, os.getlogin(), parsed_ref))
+    if record is None:
+        record = start(parsed_ref)
+    end = time()
+    # log() relies on every line starting with {"start": "<date>.
+    entry = OrderedDict()
+    entry['start'] = _timestamp(record['start'])
+    entry['end'] = _timestamp(end)
+    entry['duration'] = round(end - record['start'], 3)
+    entry['ref'] = parsed_ref
+    entry['requested'] = record['ref']
+    entry['user'] = record['user']
+    entry['host'] = env.host_string
+    entry['outcome'] = outcome
+    entry['stages'] = record['stages']
+    with batched(batch) as b:
+        b.add('Logging deployment',
+              write_command(JOURNAL, json.dumps(entry) + '\n', append=True),
+              cwd=env.host_site_path, stage='mark')
+
+def _user():
+    try:
+        return os.getlogin()
+    except OSError:
+        # There is no controlling terminal, e.g. under cron.
+        return getpass.getuser()
+
+def _timestamp(seconds):
+    return strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(seconds))
 
 @task
-def clean(age=15):
-    """
-    Clean a `path` from files older than `age` days
-    """
-    with hide('running', 'stdout'):
-        with cd('%s/changesets' % env.host_site_path):
-            # count how many we'll delete
-            count = run("""find . -maxdepth 1 -type d -mtime +%s ! -iname '\.'| wc -l""" %
-                    age)
-            # delete
-            if count != '0':
-                print('+ Removing %s deployments older than %s days' % (count, age))
-                run("""find . -maxdepth 1 -type d -mtime +%s ! -iname '\.' -print0 \
-                        | xargs -0 rm -rf""" % age)
+def clean(age=15, keep=None):
+    """
+    Retire changesets older than `age` days, or beyond the `keep` newest ones
+
+    When both are given a changeset has to fail both policies to be retired.
+    Pass `age=none` to only keep the newest changesets. The live changeset
+    and the one before it are never retired, nor are changesets prepared
+    since the live one, which are waiting to be activated. Retired changesets
+    are moved to changesets/.trash, which is cheap, and deleted by a detached
+    background job, so cleaning does not hold up a push.
+    """
+    _clean(age, keep)
+
+def _clean(age=15, keep=None, batch=None):
+    """
+    clean(), queued into `batch` if one is given
+    """
+    if str(age).lower() == 'none':
+        age = ''
+    if not age and not keep:
+        abort('Give clean an `age`, a number of changesets to `keep`, or both')
+    with batched(batch) as b:
+        b.add('Cleaning old deployments', clean_sh % {
+            'age': age and int(age) or '', 'keep': keep and int(keep) or ''},
+              cwd='%s/changesets' % env.host_site_path, show=True,
+              stage='clean')
+
+# Shell script behind clean(), run from the changesets directory. `n` counts
+# changesets newest first, the live one included.
+clean_sh = """age=%(age)s; keep=%(keep)s
+current=$(readlink ../current 2>/dev/null); current=${current%%/public}
+current=${current##*/}
+previous=""; n=0; expired=""; live=""
+for changeset in $(ls -1t); do
+  [ -d "$changeset" ] || continue
+  n=$((n + 1))
+  [ "$changeset" = "$current" ] && live=1 && continue
+  # Changesets prepared since the live one are waiting to be activated.
+  [ -z "$live" ] && [ -f "$changeset/.prepared" ] && continue
+  # The first one older than the live one is the previous release.
+  if [ -n "$live" ] && [ -z "$previous" ]; then
+    previous=$changeset; continue
+  fi
+  [ -n "$keep" ] && [ "$n" -le "$keep" ] && continue
+  [ -n "$age" ] && [ -z "$(find "$changeset" -maxdepth 0 -mtime +$age)" ] \\
+    && continue
+  expired="$expired $changeset"
+done
+if [ -n "$expired" ]; then
+  trash=.trash/$(date +%%s)
+  mkdir -p $trash && mv $expired $trash/
+  echo "Retired$expired"
+  setsid nohup sh -c '
+    before=$(df -Pk . | tail -n 1 | tr -s " " | cut -d " " -f 4)
+    rm -rf .trash/*
+    after=$(df -Pk . | tail -n 1 | tr -s " " | cut -d " " -f 4)
+    echo "$(date -u +%%FT%%TZ) reclaimed $((after - before)) KB" >> .trash.log
+  ' > /dev/null 2>&1 < /dev/null &
+fi
+[ -f .trash.log ] && echo "Last cleanup: $(tail -n 1 .trash.log)"
+echo "Keeping $(ls -1 | wc -l) changesets," \\
+  "$(df -Ph . | tail -n 1 | tr -s ' ' | cut -d ' ' -f 4) free" """
@@ -1,8 +1,16 @@
 from fabric.api import task, env, run, execute, require, sudo, prefix, cd, \
-    settings\
+    hide, put, get, abort, runs_once, settings\
     as fab_settings
 from fabric.contrib.files import exists
 from fabric.contrib.console import confirm
+from butter import profile
+from butter.host import fan_out, failed_hosts, report
+from pipes import quote
+from time import time
+import base64
+import os
+import posixpath
+import re
 
 
 @task
@@ -51,8 +59,17 @@ def uninstall():
 
 
 @task
-def deploy(ref='origin/master'):
-    """ Deploy a version of the application into an installed environment. """
+def deploy(ref='origin/master', memcached='no', migrate='auto'):
+    """
+    Deploy a version of the application into an installed environment.
+
+    syncdb and migrate only run for the apps whose models or migrations
+    changed since the last commit they ran for successfully, recorded in
+    venv/.migrated, unless `migrate=yes` is given, which runs them for every
+    app. A failed migrate aborts the deploy. The app servers are reloaded
+    gracefully. memcached keeps its cache unless `memcached=yes` is given,
+    which restarts it.
+    """
     require('host_type', 'app_path', provided_by=env.available_environments)
 
     if not exists('%(app_path)s/app' % env):
@@ -63,30 +80,75 @@ def deploy(ref='origin/master'):
         else:
             exit()
 
-    with cd(env.app_path + '/app'):
-        run('git fetch -q && git checkout -f %s' % ref)
-        run('git submodule --quiet update --init --recursive')
+    with profile.stage('checkout'):
+        with cd(env.app_path + '/app'):
+            run('git fetch -q && git checkout -f %s' % ref)
+            run('git submodule --quiet update --init --recursive')
 
-    _install_requirements()
+    with profile.stage('requirements'):
+        _install_requirements()
 
     # Django tasks
     with cd(env.app_path + '/app'):
+        plan = None
+        if migrate != 'yes':
+            plan = _migration_plan()
+        if plan is None:
+            syncdb, apps = True, None
+        else:
+            syncdb, apps = plan
         with prefix('source ../venv/bin/activate'):
-            run('python manage.py syncdb '
-                '--settings=%(django_settings_module)s --noinput' % env,
-                warn_only=True)
-            run('python manage.py migrate '
-                '--settings=%(django_settings_module)s --noinput'
-                % env, warn_only=True)
-            run('mkdir -p static && python manage.py collectstatic '
-                '--settings=%(django_settings_module)s --clear --noinput '
-                '--verbosity 0'
-                % env)
-
-    # Restart services
-    sudo('service uwsgi restart && service nginx restart && service '
-         'memcached restart', warn_only=True)
+            synced = True
+            if syncdb:
+                with profile.stage('syncdb'):
+                    synced = run('python manage.py syncdb '
+                                 '--settings=%(django_settings_module)s '
+                                 '--noinput' % env, warn_only=True).succeeded
+            commands = []
+            if apps is None or apps:
+                manage = 'python manage.py migrate --settings=%s --noinput' \
+                    % env.django_settings_module
+                commands = [manage + (app and ' ' + app)
+                            for app in apps or ['']]
+            # The next deploy diffs from the marker, so it only moves once
+            # everything up to this commit ran.
+            if synced:
+                commands.append('git rev-parse HEAD > ../venv/.migrated')
+            if commands:
+                with profile.stage('migrate'):
+                    start = time()
+                    run(' && '.join(commands))
+                    if apps is None or apps:
+                        print('+ Migrated %s in %.1fs' % (
+                            apps and ', '.join(apps) or 'every app',
+                            time() - start))
+            with profile.stage('collectstatic'):
+                _collectstatic()
 
+    # Reload services
+    with profile.stage('reload'):
+        _reload(memcached)
+
+@task
+@runs_once
+def reload(batch_size=1, memcached='no'):
+    """
+    Gracefully reload the app servers of all hosts, `batch_size` at a time
+
+    The next batch is only reloaded once every host of the previous one
+    passed its health check, when env.health_check_url is set. memcached is
+    restarted if `memcached=yes`.
+    """
+    batch_size = int(batch_size)
+    for i in range(0, len(env.hosts), batch_size):
+        batch = env.hosts[i:i + batch_size]
+        print('+ Reloading %s' % ', '.join(batch))
+        results = fan_out(_reload, (memcached,), hosts=batch)
+        report(results)
+        failed = failed_hosts(results)
+        if failed:
+            abort('Reloading failed on %s, the hosts after it were not '
+                  'reloaded' % ', '.join(failed))
 
 @task
 def manage(cmd):
@@ -112,7 +174,268 @@ def log(how_many=1):
 ################################################################################
 
 def _install_requirements():
+    """
+    Install the requirements of env.host_type, unless they were installed
+    already. Packages are installed from a wheelhouse built once per version
+    of the requirements, in env.wheelhouse (app_path/wheelhouse by default),
+    which is copied over to the other hosts rather than built again. If it
+    can't be built, they are installed with a plain pip install.
+    """
     require('host_type', 'app_path', provided_by=env.available_environments)
+    with cd(env.app_path):
+        with hide('running', 'stdout'):
+            lines = run('cat venv/.requirements 2>/dev/null; '
+                        'cat app/requirements/*.txt | sha1sum').splitlines()
+    # Requirements files may include one another, so all of them count.
+    key = '%s-%s' % (env.host_type, lines[-1].split()[0][:12])
+    if len(lines) > 1 and lines[-2].strip() == key:
+        print('+ Requirements are unchanged')
+        return
+
+    wheelhouse = '%s/%s' % (getattr(env, 'wheelhouse',
+                                    env.app_path + '/wheelhouse'), key)
+    built = _ensure_wheelhouse(wheelhouse, key)
+    requirements = 'app/requirements/%(host_type)s.txt' % env
     with prefix('cd %(app_path)s && source venv/bin/activate' % env):
         run('pip install -q -U distribute')
-        run('pip install -q -r app/requirements/%(host_type)s.txt' % env)
+        if not built:
+            print('+ Installing requirements without a wheelhouse')
+            run('pip install -q -r %s' % requirements)
+            run('echo %s > venv/.requirements' % key)
+            return
+        print('+ Installing requirements from %s' % wheelhouse)
+        result = run('pip install -q --no-index --find-links %s -r %s' %
+                     (wheelhouse, requirements), warn_only=True)
+        if result.failed:
+            # E.g. editable requirements can't be installed from wheels.
+            run('pip install -q --find-links %s -r %s' % (wheelhouse,
+                                                          requirements))
+        run('echo %s > venv/.requirements' % key)
+
+def _migration_plan():
+    """
+    Works out what the models and migrations that changed since the commit
+    recorded in venv/.migrated need: whether syncdb has to run, because the
+    models of an app without migrations changed, and the labels of the apps
+    to migrate. Returns None if it can't tell, e.g. on a first deploy, or if
+    the settings or the requirements changed. Run from the app.
+    """
+    settings_path = env.django_settings_module.replace('.', '/')
+    trigger = [settings_path + '.py', settings_path + '/', 'requirements/']
+    if posixpath.basename(posixpath.dirname(settings_path)) == 'settings':
+        trigger.append(posixpath.dirname(settings_path) + '/')
+    with fab_settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run("previous=$(cat ../venv/.migrated) && "
+                  "[ -n \"$previous\" ] && echo $previous && "
+                  "git diff --name-only $previous HEAD -- %s && echo -- && "
+                  "git diff --name-only $previous HEAD -- '*models.py' "
+                  "'*/models/*' '*/migrations/*' && echo -- && "
+                  "git ls-tree -d -r --name-only HEAD | "
+                  "{ grep -E '(^|/)migrations$' || true; }" %
+                  ' '.join([quote(path) for path in trigger]))
+    if out.failed:
+        print('+ No commit to diff from in venv/.migrated, running syncdb '
+              'and migrate for every app')
+        return None
+    lines = out.splitlines()
+    previous = lines[0].strip()
+    first = lines.index('--')
+    second = lines.index('--', first + 1)
+    if first > 1:
+        print('+ Settings or requirements changed since %s, running syncdb '
+              'and migrate for every app' % previous[:12])
+        return None
+    changed = lines[first + 1:second]
+    # Directories of the apps that have migrations.
+    migrated = set([posixpath.dirname(path) for path in
+                    lines[second + 1:]])
+
+    syncdb = False
+    apps = set()
+    for path in changed:
+        parts = path.split('/')
+        if 'migrations' in parts[:-1]:
+            app = '/'.join(parts[:parts.index('migrations')])
+            if not app:
+                return None
+            apps.add(app.split('/')[-1])
+        else:
+            if 'models' in parts[:-1]:
+                app = '/'.join(parts[:parts.index('models')])
+            else:
+                app = posixpath.dirname(path)
+            if app not in migrated:
+                syncdb = True
+    if not changed:
+        print('+ No models or migrations changed since %s, skipping syncdb '
+              'and migrate' % previous[:12])
+    else:
+        print('+ %d model and migration files changed since %s: %s' % (
+            len(changed), previous[:12], ', '.join(
+                (syncdb and ['syncdb'] or []) +
+                ['migrate %s' % label for label in sorted(apps)]) or
+            'nothing to run'))
+    return syncdb, sorted(apps)
+
+def _reload(memcached='no'):
+    """
+    Reload uwsgi and nginx without dropping requests, and check that the host
+    still serves env.health_check_url, if it is set.
+
+    uwsgi is reloaded through its master FIFO when env.uwsgi_fifo is set,
+    with a chain reload if env.uwsgi_reload is 'chain' (this needs
+    lazy-apps), and with its init script otherwise.
+    """
+    fifo = getattr(env, 'uwsgi_fifo', None)
+    if fifo:
+        chain = getattr(env, 'uwsgi_reload', 'graceful') == 'chain'
+        commands = ['echo %s > %s' % (chain and 'c' or 'r', fifo)]
+    else:
+        commands = ['service uwsgi reload']
+    commands.append('nginx -t -q && service nginx reload')
+    if memcached == 'yes':
+        commands.append('service memcached restart')
+    print('+ Reloading services')
+    sudo(' && '.join(commands))
+    _health_check()
+
+def _health_check():
+    """
+    Check that the host serves env.health_check_url, retrying for
+    env.health_check_retries seconds. Skipped if no URL is set.
+    """
+    url = getattr(env, 'health_check_url', None)
+    if not url:
+        return
+    retries = int(getattr(env, 'health_check_retries', 10))
+    with hide('running'):
+        result = run('for i in $(seq %d); do '
+                     'curl -fsS -o /dev/null --max-time 5 %s && exit 0; '
+                     'sleep 1; done; exit 1' % (retries, quote(url)),
+                     warn_only=True)
+    if result.failed:
+        abort('%s failed its health check at %s' % (env.host_string, url))
+    print('+ %s is healthy' % env.host_string)
+
+def _collectstatic():
+    """
+    Collect the static files that changed since the last deploy, and remove
+    the ones that are gone.
+
+    The files in the repository under `env.static_paths` (directories named
+    static by default), the commits of its submodules and the installed
+    requirements make up a key; when it is unchanged, collectstatic is
+    skipped. The key and the collected files
+    are kept in .butter-static under STATIC_ROOT. Run from the app with the
+    virtualenv active.
+    """
+    paths = getattr(env, 'static_paths', ['static/'])
+    with fab_settings(hide('running', 'stdout'), warn_only=True):
+        lines = run('echo %s | base64 -d | DJANGO_SETTINGS_MODULE=%s '
+                    'python - 2>/dev/null; '
+                    '(git ls-tree -r HEAD | grep %s; '
+                    'git submodule status --recursive; '
+                    'cat ../venv/.requirements) 2>/dev/null | sha1sum' %
+                    (base64.b64encode(static_key_py),
+                     env.django_settings_module,
+                     ' '.join(['-e %s' % quote(path) for path in paths]))
+                    ).splitlines()
+    key = lines[-1].split()[0]
+    if len(lines) > 1 and lines[-2].strip() == key:
+        print('+ Static files are unchanged')
+        return
+
+    with hide('running', 'stdout'):
+        out = run('mkdir -p static && python manage.py collectstatic '
+                  '--settings=%(django_settings_module)s --noinput '
+                  '--verbosity 1' % env)
+        pruned = run('echo %s | base64 -d | DJANGO_SETTINGS_MODULE=%s '
+                     'python - %s' % (base64.b64encode(prune_static_py),
+                                      env.django_settings_module, key))
+    copied = re.search(r'(\d+) static files? copied', out)
+    unmodified = re.search(r'(\d+) unmodified', out)
+    print('+ Static files: %s copied, %s unmodified, %s removed' % (
+        copied and copied.group(1) or 0,
+        unmodified and unmodified.group(1) or 0,
+        pruned.strip().splitlines()[-1]))
+
+# Prints the key of the last collectstatic, from .butter-static under
+# STATIC_ROOT.
+static_key_py = """
+import os, sys
+sys.path.insert(0, os.getcwd())
+from django.conf import settings
+
+manifest = os.path.join(settings.STATIC_ROOT, '.butter-static')
+if os.path.exists(manifest):
+    print(open(manifest).readline().strip())
+"""
+
+# Removes the files a previous collectstatic collected that no static files
+# finder provides anymore, and records the new key and collected files in
+# .butter-static under STATIC_ROOT. Prints the number of files removed.
+prune_static_py = """
+import json, os, sys
+sys.path.insert(0, os.getcwd())
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+
+collected = set()
+for finder in get_finders():
+    for path, storage in finder.list(['CVS', '.*', '*~']):
+        prefix = getattr(storage, 'prefix', None)
+        collected.add(prefix and os.path.join(prefix, path) or path)
+
+manifest = os.path.join(settings.STATIC_ROOT, '.butter-static')
+previous = []
+if os.path.exists(manifest):
+    previous = json.loads(open(manifest).read().split('\\n', 1)[1])
+removed = 0
+for path in set(previous) - collected:
+    if os.path.exists(os.path.join(settings.STATIC_ROOT, path)):
+        os.remove(os.path.join(settings.STATIC_ROOT, path))
+        removed += 1
+out = open(manifest, 'w')
+out.write(sys.argv[1] + '\\n' + json.dumps(sorted(collected)))
+out.close()
+print(removed)
+"""
+
+def _ensure_wheelhouse(wheelhouse, key):
+    """
+    Make sure the wheelhouse for `key` is on the host: upload a copy built on
+    another host, or build it and keep a copy here for the next hosts.
+    Returns False if it could not be built, e.g. because pip is too old or
+    the wheel package is missing.
+    """
+    cache = os.path.expanduser('~/.butter/wheelhouse/%s.tar.gz' % key)
+    if exists(wheelhouse):
+        return True
+    if os.path.exists(cache):
+        print('+ Uploading wheelhouse %s' % key)
+        with hide('running'):
+            run('mkdir -p %s.tmp' % wheelhouse)
+            put(cache, '%s.tar.gz' % wheelhouse)
+            run('tar xzf %s.tar.gz -C %s.tmp && rm %s.tar.gz && mv %s.tmp %s'
+                % ((wheelhouse,) * 5))
+        return True
+
+    print('+ Building wheelhouse %s' % key)
+    with prefix('cd %(app_path)s && source venv/bin/activate' % env):
+        result = run('rm -rf %s.tmp && pip wheel -q -r '
+                     'app/requirements/%s.txt -w %s.tmp && mv %s.tmp %s' % (
+                         wheelhouse, env.host_type, wheelhouse, wheelhouse,
+                         wheelhouse), warn_only=True)
+    if result.failed:
+        run('rm -rf %s.tmp' % wheelhouse)
+        return False
+    if not os.path.isdir(os.path.dirname(cache)):
+        os.makedirs(os.path.dirname(cache))
+    with hide('running'):
+        run('tar czf %s.tar.gz -C %s .' % (wheelhouse, wheelhouse))
+        get('%s.tar.gz' % wheelhouse, cache)
+        run('rm %s.tar.gz' % wheelhouse)
+    return True
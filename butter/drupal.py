@@ -1,35 +1,184 @@
 from __future__ import with_statement
-from fabric.api import task, env, cd, hide, execute, settings
-from fabric.operations import run, prompt, put
+from fabric.api import task, env, cd, hide, settings, abort, runs_once
+from fabric.operations import run
 from fabric.contrib import files
 from fabric.contrib import console
-from urlparse import urlparse
 from butter import deploy, sync as butter_sync
-from butter.host import pre_clean
+from butter.host import pre_clean, fan_out, failed_hosts, report
+from butter.batch import Batch, batched, write_command
 from butter.deprecated import legacy_settings
-from .drush import solrindex
-import StringIO
+from butter import drush
+from pipes import quote
+from time import time
+import json
+import re
+
+# Tables of Drupal 7 and 8 that are copied as structure only by sync_db.
+butter_sync.profiles['drupal'] = {
+    'structure_only': [
+        'cache', 'cache_*', 'cachetags', 'ctools_css_cache',
+        'ctools_object_cache', 'views_data_object_cache', 'watchdog',
+        'accesslog', 'sessions', 'flood', 'semaphore', 'batch', 'queue',
+        'history', 'key_value_expire', 'search_index', 'search_dataset',
+        'search_total', 'search_node_links', 'search_api_db_*',
+    ],
+    'skip': [],
+}
 
 @task
 def push(ref):
     """
     Deploy a commit to a host
     """
+    with deploy.journal(deploy.start(ref)) as record:
+        _prepare(ref, record)
+        _activate(record['parsed_ref'], record)
 
-    if env.repo_type == 'git':
-        from butter import git as repo
-    elif env.repo_type == 'hg':
-        from butter import hg as repo
-    parsed_ref = repo.check_commit(ref)
-    deploy.clean()
-    build_path = '%s/changesets/%s' % (env.host_site_path, parsed_ref)
-    pre_clean(build_path)
-    repo.checkout(parsed_ref)
-    settings_php(build_path)
-    restrict_robots(build_path)
-    set_perms(build_path)
-    link_files(build_path)
-    deploy.mark(parsed_ref)
+@task
+@runs_once
+def push_all(ref, pool_size=None):
+    """
+    Deploy a commit to all hosts at once, switching them over together
+
+    The changeset is prepared on every host in parallel, at most `pool_size`
+    hosts at a time. The ref is resolved and settings.php rendered once
+    beforehand, so every host gets the same commit; with
+    `env.changeset_mode = 'artifact'` it is built then too, and uploaded to
+    the hosts in parallel. The `current` symlinks are only switched once
+    every host has prepared successfully.
+    """
+    # Resolve the ref and render settings.php once, the hosts inherit both
+    # and only make sure they have the commit.
+    render_settings(str(_repo().check_commit(ref)))
+    print('+ Preparing %s on %d hosts' % (ref, len(env.hosts)))
+    prepared = fan_out(_prepare_host, (ref,), pool_size=pool_size)
+    report(prepared)
+    failed = failed_hosts(prepared)
+    if failed:
+        abort('Preparing %s failed on %s. No host was switched over.' %
+              (ref, ', '.join(failed)))
+    records = dict([(host, result['result'])
+                    for host, result in prepared.items()])
+    parsed_refs = set([record['parsed_ref'] for record in records.values()])
+    if len(parsed_refs) > 1:
+        abort('Hosts resolved %s to different commits: %s' %
+              (ref, ', '.join(sorted(parsed_refs))))
+    parsed_ref = parsed_refs.pop()
+
+    print('+ Switching %d hosts to %s' % (len(env.hosts), parsed_ref))
+    activated = fan_out(_activate_host, (records,), pool_size=pool_size)
+    report(activated)
+    failed = failed_hosts(activated)
+    if failed:
+        abort('Switching to %s failed on %s' % (parsed_ref, ', '.join(failed)))
+
+@task
+def prepare(ref):
+    """
+    Build the changeset of a commit on a host, without making it live
+
+    Several commits can be prepared ahead of time. `activate` makes one live.
+    """
+    with deploy.journal(deploy.start(ref), mark_success=False) as record:
+        parsed_ref = _prepare(ref, record)
+    print('+ Prepared %s, run activate:%s to make it live' % (parsed_ref, ref))
+
+@task
+def activate(ref, verify='no'):
+    """
+    Make a changeset built by `prepare` live
+
+    `ref` is the ref the changeset was prepared from, or its commit. With
+    `verify=yes` the changeset is first checked against the fingerprint taken
+    when it was prepared.
+    """
+    candidates = [changeset for changeset in
+                  _prepared_changesets(verify == 'yes') if
+                  ref in (changeset['ref'], changeset['parsed_ref']) or
+                  changeset['parsed_ref'].startswith(ref)]
+    if not candidates:
+        abort('%s is not prepared on %s' % (ref, env.host_string))
+    changeset = candidates[0]
+    if verify == 'yes' and not changeset['valid']:
+        abort('The changeset of %s changed since it was prepared' % ref)
+    record = deploy.start(changeset['ref'])
+    record['parsed_ref'] = changeset['parsed_ref']
+    with deploy.journal(record):
+        _activate(changeset['parsed_ref'], record)
+
+@task
+def prepared(verify='yes'):
+    """
+    List the prepared changesets on a host, newest first, and whether they
+    are still as they were prepared
+    """
+    changesets = _prepared_changesets(verify == 'yes')
+    with hide('running', 'stdout'):
+        current = run('readlink %s/current' % env.host_site_path,
+                      warn_only=True)
+    print('+ Prepared changesets on %s' % env.host_string)
+    for changeset in changesets:
+        if changeset['valid'] is None:
+            status = 'unchecked'
+        else:
+            status = changeset['valid'] and 'valid' or 'CHANGED'
+        if current.startswith(_build_path(changeset['parsed_ref']) + '/'):
+            status += ', live'
+        print('  %s  %s  %-20s %-10s %s' % (
+            changeset['prepared'], changeset['parsed_ref'], changeset['ref'],
+            changeset['user'], status))
+
+@task
+def rollback(ref=None):
+    """
+    Switch a host back to the most recent other deployment, or to `ref`
+
+    Only changesets still on the host, as found in the deployment journal,
+    can be rolled back to. Nothing is rebuilt, the `current` symlink is
+    switched over as by `activate`.
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        with cd(env.host_site_path):
+            out = run('readlink current; echo __butter_section__; '
+                      'ls -1 changesets; echo __butter_section__; '
+                      'grep -F %s %s | tail -n 100' % (
+                          quote('"outcome": "success"'), deploy.JOURNAL))
+    sections = out.split('__butter_section__')
+    if len(sections) != 3:
+        abort('Could not read the changesets of %s' % env.host_string)
+    live = sections[0].strip()
+    if live.endswith('/public'):
+        live = live[:-len('/public')]
+    live = live.split('/')[-1]
+    changesets = sections[1].split()
+
+    target = None
+    for line in reversed(sections[2].strip().splitlines()):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if entry['ref'] not in changesets:
+            continue
+        if ref is None and entry['ref'] != live or ref is not None and (
+                ref == entry['requested'] or entry['ref'].startswith(ref)):
+            target = entry['ref']
+            break
+    if target is None and ref is not None:
+        # The journal may not go back that far.
+        matches = [name for name in changesets if name.startswith(ref)]
+        if len(matches) == 1:
+            target = matches[0]
+    if target is None:
+        abort('No changeset to roll back to on %s' % env.host_string)
+    if target == live:
+        abort('%s is already live on %s' % (target, env.host_string))
+
+    print('+ Rolling back %s from %s to %s' % (env.host_string, live, target))
+    record = deploy.start(ref or 'rollback')
+    record['parsed_ref'] = target
+    with deploy.journal(record):
+        _activate(target, record)
 
 @task
 def setup_env():
@@ -59,7 +208,151 @@ def setup_env():
     print('+ Site directory structure created at: %s' % env.host_site_path)
 
 
-def settings_php(build_path):
+def _repo():
+    if getattr(env, 'changeset_mode', 'copy') == 'artifact':
+        from butter import artifact as repo
+    elif env.repo_type == 'git':
+        from butter import git as repo
+    elif env.repo_type == 'hg':
+        from butter import hg as repo
+    return repo
+
+def _build_path(parsed_ref):
+    return '%s/changesets/%s' % (env.host_site_path, parsed_ref)
+
+def _prepare(ref, record):
+    """
+    Build the changeset for `ref` without making it live. Returns the parsed
+    ref.
+
+    A changeset that is live, or prepared and unchanged since, is not checked
+    out again, only its settings.php and permissions are brought up to date.
+    Everything after resolving the ref is queued into a single batch, so it
+    costs one round trip to the host. Stage timings are added to the journal
+    `record`.
+    """
+    repo = _repo()
+    with deploy.stage(record, 'check_commit'):
+        parsed_ref = str(repo.check_commit(ref))
+    record['parsed_ref'] = parsed_ref
+    build_path = _build_path(parsed_ref)
+    built = _built(build_path)
+    batch = Batch()
+    deploy._clean(batch=batch)
+    if built:
+        print('+ %s is %s already, only updating its settings' % (parsed_ref,
+                                                                   built))
+    else:
+        pre_clean(build_path, batch)
+        with deploy.stage(record, 'checkout'):
+            repo.checkout(parsed_ref, batch)
+    with deploy.stage(record, 'settings_php'):
+        settings_php(build_path, batch, parsed_ref)
+    if not built:
+        restrict_robots(build_path, batch)
+    set_perms(build_path, batch)
+    mark_prepared(build_path, record, batch)
+    try:
+        batch.run()
+    finally:
+        deploy.add_steps(record, batch.results)
+    return parsed_ref
+
+def _built(build_path):
+    """
+    Returns 'live' if the changeset at `build_path` is live, 'prepared' if it
+    is prepared and its files still match their fingerprint, or None.
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run('if [ "$(readlink %(site)s/current)" = %(build)s/public ]; '
+                  'then\n'
+                  '  echo live\n'
+                  'elif [ -f %(build)s/.prepared ] && [ "$(sed -n 2p '
+                  '%(build)s/.prepared)" = "$(cd %(build)s && %(print)s)" ]; '
+                  'then\n'
+                  '  echo prepared\n'
+                  'fi' % {'site': env.host_site_path, 'build': build_path,
+                          'print': fingerprint_sh})
+    return out.strip() or None
+
+def _activate(parsed_ref, record):
+    """
+    Make a prepared changeset live
+    """
+    batch = Batch()
+    link_files(_build_path(parsed_ref), batch)
+    try:
+        batch.run()
+    finally:
+        deploy.add_steps(record, batch.results)
+
+def _prepare_host(ref):
+    """
+    push_all's prepare phase on one host. Returns the journal record.
+    """
+    with deploy.journal(deploy.start(ref), mark_success=False) as record:
+        _prepare(ref, record)
+    return record
+
+def _activate_host(records):
+    """
+    push_all's activate phase on one host
+    """
+    record = records[env.host_string]
+    with deploy.journal(record):
+        _activate(record['parsed_ref'], record)
+
+# Fingerprint of the files of a changeset, run from its directory.
+fingerprint_sh = "find public -type f -exec md5sum {} + | LC_ALL=C sort | " \
+    "md5sum | cut -d ' ' -f 1"
+
+def mark_prepared(build_path, record, batch=None):
+    """
+    Write the .prepared marker of a changeset: the ref it was prepared from,
+    when and by whom, and a fingerprint of its files
+    """
+    marker = json.dumps({'ref': record['ref'],
+                         'parsed_ref': record['parsed_ref'],
+                         'user': record['user'],
+                         'prepared': deploy._timestamp(time())})
+    with batched(batch) as b:
+        b.add('Marking the changeset prepared',
+              '%s && %s >> .prepared' % (write_command('.prepared',
+                                                       marker + '\n'),
+                                         fingerprint_sh),
+              cwd=build_path, stage='mark_prepared')
+
+def _prepared_changesets(verify=False):
+    """
+    Returns the changesets with a .prepared marker, newest first, as
+    dictionaries of the marker's fields, and `valid`: whether the files still
+    match the fingerprint, or None without `verify`.
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        with cd('%s/changesets' % env.host_site_path):
+            out = run('for changeset in $(ls -1t); do\n'
+                      '  [ -f $changeset/.prepared ] || continue\n'
+                      '  echo __butter_changeset__\n'
+                      '  head -n 2 $changeset/.prepared\n'
+                      '  %s\n'
+                      'done' % (verify and '(cd $changeset && %s)' %
+                                fingerprint_sh or 'echo -'))
+    changesets = []
+    for chunk in out.split('__butter_changeset__')[1:]:
+        lines = chunk.strip().splitlines()
+        if len(lines) < 3:
+            continue
+        try:
+            changeset = json.loads(lines[0])
+        except ValueError:
+            continue
+        changeset['valid'] = None
+        if verify:
+            changeset['valid'] = lines[1].strip() == lines[2].strip()
+        changesets.append(changeset)
+    return changesets
+
+def settings_php(build_path, batch=None, parsed_ref=None):
     """
     Setup settings.php file, with variable interpolation
 
@@ -67,77 +360,153 @@ def settings_php(build_path):
     env.settings dictionary. Dictionary keys will be translated from `key`
     to `%%KEY%%`
     """
-    print('+ Configuring site settings.php')
-    legacy_settings()
-    with cd('%s/public/sites/default' % build_path):
-        file = "settings.%s.php" % env.host_type
-        if files.exists(file):
-            for key in env.settings:
-                files.sed(file, '%%' + key.upper() + '%%', env.settings[key])
-
-            if files.exists('settings.php'):
-                run('rm settings.php')
-            run('cp settings.%s.php settings.php' % env.host_type )
-            run('rm settings.*.php settings.*.bak')
-        else:
-            run('ls -lah')
+    if parsed_ref is None:
+        parsed_ref = build_path.rstrip('/').split('/')[-1]
+    content = render_settings(parsed_ref)
+    with batched(batch) as b:
+        b.add('Configuring site settings.php',
+              # Replaced in one rename, the changeset may be live.
+              'rm -f settings.*.php settings.*.bak && ' +
+              write_command('settings.php.tmp', content) +
+              ' && mv -f settings.php.tmp settings.php',
+              cwd='%s/public/sites/default' % build_path,
+              stage='settings_php')
+
+# Rendered settings.php files by (host type, ref).
+_rendered_settings = {}
+
+def render_settings(parsed_ref):
+    """
+    Returns the settings.<host_type>.php template of `parsed_ref`, with every
+    `%%KEY%%` replaced in one pass.
+
+    The result is cached per host type and ref, so a push to several hosts
+    fetches and renders the template once.
+    """
+    key = (env.host_type, parsed_ref)
+    if key not in _rendered_settings:
+        print('+ Rendering settings.%s.php' % env.host_type)
+        legacy_settings()
+        file = 'settings.%s.php' % env.host_type
+        template = _repo().read_file(parsed_ref,
+                                     'public/sites/default/%s' % file)
+        if template is None:
             abort('Could not find %s' % file)
+        values = dict([(name.upper(), str(value))
+                       for name, value in env.settings.items()])
+        _rendered_settings[key] = re.sub(
+            r'%%(\w+)%%', lambda match: values.get(match.group(1),
+                                                  match.group(0)), template)
+    return _rendered_settings[key]
 
-def restrict_robots(build_path):
+def restrict_robots(build_path, batch=None):
     """
     Restrict QA/Staging robots.txt
     """
     if env.host_type in { 'qa', 'staging' }:
-        print('+ Restricting robots')
         file = '%s/public/robots.txt' % build_path
-        robotstxt = StringIO.StringIO();
-        robotstxt.name = 'robots.txt'
-        robotstxt.write('User-agent: *\n')
-        robotstxt.write('Disallow: /')
-        put(robotstxt, file);
-
-def set_perms(build_path):
-    print('+ Setting Drupal permissions')
-    with cd(env.host_site_path):
-        run('chown %s:%s %s && chgrp -R %s %s' % (env.user,
-            env.host_webserver_user, build_path, env.host_webserver_user,
-            build_path))
-        run('chmod -R 2770 %s' % build_path)
-        run('chmod 0440 %s/public/sites/default/settings*' % build_path)
-
-def link_files(build_path):
-    print('+ Creating symlinks')
+        with batched(batch) as b:
+            b.add('Restricting robots',
+                  # Unlink first, the file may be hard-linked to another
+                  # changeset.
+                  "rm -f %s && printf 'User-agent: *\\nDisallow: /' > %s"
+                  % (file, file), stage='restrict_robots')
+
+def set_perms(build_path, batch=None):
+    """
+    Give the changeset the webserver's group and mode 2770, with read-only
+    settings files. Only entries that are not set right already are changed.
+    """
+    settings_files = '%s/public/sites/default/settings*' % build_path
+    with batched(batch) as b:
+        b.add('Setting Drupal permissions',
+              'chown %s:%s %s && %s' % (env.user, env.host_webserver_user,
+                                        build_path, fix_perms_sh([
+                  (build_path, {'group': env.host_webserver_user,
+                                'mode': '2770', 'exclude': settings_files}),
+                  (settings_files, {'mode': '0440'})])),
+              cwd=env.host_site_path, show=True, stage='set_perms')
+
+def fix_perms_sh(rules):
+    """
+    Returns a shell command that applies `rules`, a list of (path, options)
+    pairs, and prints how many entries it changed. Options are the `owner`,
+    `group` and `mode` entries under the path should have, and a pattern of
+    paths to `exclude` from the mode. Only entries that differ are changed,
+    so applying rules to a tree that follows them only costs a `find`.
+    """
+    finds = []
+    for path, options in rules:
+        owner, group = options.get('owner'), options.get('group')
+        if owner or group:
+            wrong = []
+            if owner:
+                wrong.append('! -user %s' % owner)
+            if group:
+                wrong.append('! -group %s' % group)
+            finds.append('find %s \\( %s \\) -print -exec %s -h %s {} +' % (
+                path, ' -o '.join(wrong), owner and 'chown' or 'chgrp',
+                owner and '%s:%s' % (owner, group or '') or group))
+        if options.get('mode'):
+            exclude = ''
+            if options.get('exclude'):
+                exclude = "! -path '%s' " % options['exclude']
+            finds.append('find %s ! -type l %s! -perm %s -print '
+                         '-exec chmod %s {} +' % (path, exclude,
+                                                  options['mode'],
+                                                  options['mode']))
+    return ('fixed=$(set -o pipefail; { %s; } | wc -l); rc=$?; '
+            'echo "Fixed $fixed entries"; [ $rc -eq 0 ]' % ' && '.join(finds))
+
+def link_files(build_path, batch=None):
+    """
+    Link the files directory into `build_path` and make it live. Both
+    symlinks are replaced by renaming a new one over them, so `current` never
+    goes missing.
+    """
     ensure_files_path()
-    with cd(build_path):
-        run('rm -rf %s' % env.files_path)
-        run('ln -s %s/files %s' % (env.host_site_path, env.files_path))
-    with cd(env.host_site_path):
-        run('if [ -h current ] ; then unlink current ; fi')
-        run('ln -s %s/public current' % build_path)
+    with batched(batch) as b:
+        b.add('Creating symlinks',
+              'cd %(build)s && rm -rf %(files)s.tmp && '
+              'ln -s %(site)s/files %(files)s.tmp && '
+              '{ [ -h %(files)s ] || rm -rf %(files)s; } && '
+              'mv -T %(files)s.tmp %(files)s && '
+              'cd %(site)s && rm -f current.tmp && '
+              'ln -s %(build)s/public current.tmp && '
+              'mv -T current.tmp current' % {'build': build_path,
+                                             'files': env.files_path,
+                                             'site': env.host_site_path},
+              stage='link_files')
 
 @task
-def sync_files(dst, opts_string=''):
+def sync_files(dst, opts_string='', engine=None, jobs=8, full='no'):
     """
     Syncs Drupal files from the environment's S3 bucket to `dst`.
+
+    See sync.files for the `engine`, `jobs` and `full` options.
     """
     ensure_files_path()
     exclude = ['*styles/*', '*xmlsitemap/*', '*js/*', '*css/*', '*ctools/*']
     opts_string += ' ' + ' '.join(["--exclude '%s'" % v for v in exclude])
-    butter_sync.files(dst, opts_string)
+    butter_sync.files(dst, opts_string, engine=engine, jobs=jobs, full=full)
 
 @task
-def sync_db(src, dst):
+def sync_db(src, dst, profile='drupal', engine=None, incremental='no'):
     """
     Copies a Drupal database from `src` to `dst` environment.
+
+    Caches, logs, sessions and other tables Drupal rebuilds on its own are
+    copied as structure only, unless `profile=none` is given.
     """
-    butter_sync.db(src, dst)
+    butter_sync.db(src, dst, engine=engine, incremental=incremental,
+                   profile=profile)
 
 @task
-def sync(src, dst):
+def sync(src, dst, profile='drupal'):
     """
     Moves drupal sites between servers
     """
-    sync_db(src, dst);
+    sync_db(src, dst, profile);
     sync_files(dst);
     print('+ Site synced from %s to %s' % (src, dst))
 
@@ -196,10 +565,11 @@ def build(dev='yes'):
              # @todo: remove direct calls to drush and replace with execute() once
              # global local vs. remote context has been figured out.
              # execute(solrindex);
+             modules = drush.enabled_modules(run_function, **run_args)
              with settings(hide('warnings'), warn_only=True):
-                 if run_function('drush pml --status=enabled | grep apachesolr', **run_args).succeeded:
+                 if 'apachesolr' in modules:
                     run_function('drush solr-delete-index && drush solr-mark-all && drush solr-index')
-                 if run_function('drush pml --status=enabled | grep search', **run_args).succeeded:
+                 if 'search' in modules:
                     run_function('drush search-index')
 
 @task
@@ -207,8 +577,9 @@ def enforce_perms():
     from fabric.api import sudo
     print('+ Setting file permissions with sudo')
     with cd(env.host_site_path):
-        sudo('chown -R %s:%s files && chmod -R 2770 files' % (env.user,
-            env.host_webserver_user))
+        sudo(fix_perms_sh([('files', {'owner': env.user,
+                                      'group': env.host_webserver_user,
+                                      'mode': '2770'})]))
 
 def ensure_files_path():
     if not 'files_path' in env:
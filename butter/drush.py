@@ -1,39 +1,203 @@
 from __future__ import with_statement
-from fabric.api import task, env, cd, settings, hide
+from fabric.api import task, env, abort, cd, settings, hide
 from fabric.operations import run
+from butter.batch import batched
+from collections import OrderedDict
+
+# Search indexes reindex() rebuilds, by the module that provides them: how to
+# clear the index, index a batch of `batch_size` items, and count the items
+# left to index. Each module keeps track of what it indexed, so batches run
+# one after the other and an interrupted run picks up where it stopped.
+search_backends = OrderedDict([
+    ('apachesolr', {
+        'clear': 'drush --yes solr-delete-index && drush --yes solr-mark-all',
+        'index': 'drush --yes solr-index --limit=%(batch_size)d',
+        'remaining': "drush php-eval '$status = apachesolr_index_status("
+                     "apachesolr_default_environment()); "
+                     "print $status[\"remaining\"];'",
+    }),
+    ('search', {
+        'clear': 'drush --yes search-reindex',
+        'index': "drush php-eval 'global $conf; "
+                 "$conf[\"search_cron_limit\"] = %(batch_size)d; "
+                 "search_cron();'",
+        'remaining': "drush php-eval '$status = node_search_status(); "
+                     "print $status[\"remaining\"];'",
+    }),
+])
+
+# Drush commands of the tasks below, and their labels, by task name.
+_commands = {
+    'cc': ('cc all', 'Running drush cc'),
+    'updatedb': ('updatedb', 'Running drush updatedb'),
+    'cron': ('cron', 'Running drush cron'),
+    'migrate_rollback': ('migrate-rollback --all',
+                         'Rolling back all migrations'),
+    'solrindex': (['solr-delete-index', 'solr-mark-all', 'solr-index'],
+                  'Rebuilding Solr index'),
+}
 
 @task
 def cc():
-    print('+ Running drush cc')
-    _drush('cc all')
+    _drush(*_commands['cc'])
 
 @task
 def updatedb():
-    print('+ Running drush updatedb')
-    _drush('updatedb')
+    _drush(*_commands['updatedb'])
 
 @task
 def cron():
-    print('+ Running drush cron')
-    _drush('cron')
+    _drush(*_commands['cron'])
 
 @task
 def migrate(migrations):
-    print('+ Running migrations')
-    _drush('migrate-import ' + migrations)
+    _drush('migrate-import ' + migrations, 'Running migrations')
 
 @task
 def migrate_rollback():
-    print('+ Rolling back all migrations')
-    _drush('migrate-rollback --all')
+    _drush(*_commands['migrate_rollback'])
 
 @task
 def solrindex():
-    print('+ Rebuilding Solr index')
-    _drush('solr-delete-index && drush solr-mark-all && drush solr-index')
+    _drush(*_commands['solrindex'])
 
 @task
-def _drush(cmd):
+def reindex(batch_size=500, workers=2, resume='yes'):
+    """
+    Rebuild the search indexes of the site, `batch_size` items at a time
+
+    Indexes of different modules are rebuilt side by side, up to `workers` at
+    once, so `workers` only matters for sites with both apachesolr and core
+    search enabled; the batches of one index always run in turn. Progress is
+    checkpointed, so a run that was interrupted resumes where it stopped,
+    unless `resume=no` is given.
+    """
     with cd('%s/current' % env.host_site_path):
-        with settings(hide('warnings'), warn_only=True):
-            run('drush ' + cmd)
+        script = reindex_script(enabled_modules(), int(batch_size),
+                                int(workers), resume == 'yes')
+        if script is None:
+            print('+ No search module is enabled')
+            return
+        print('+ Rebuilding search indexes')
+        with settings(hide('running'), warn_only=True):
+            run(script)
+
+def enabled_modules(run_function=run, **run_args):
+    """
+    Returns the names of the enabled modules, in one drush call
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run_function('drush pml --status=enabled --type=module --pipe',
+                           **run_args)
+    return out.split()
+
+def reindex_script(modules, batch_size=500, workers=2, resume=True,
+                   state=None):
+    """
+    Returns a shell script that rebuilds the search indexes of `modules`, or
+    None if none of them provides one. The script is run from the Drupal
+    root, and keeps its checkpoints in `state`.
+    """
+    backends = [name for name in search_backends if name in modules]
+    if not backends:
+        return None
+    if state is None:
+        state = '%s/private/reindex.state' % env.host_site_path
+    lines = ['state=%s' % state, 'mkdir -p $(dirname $state)',
+             'rm -f $state.failed']
+    if not resume:
+        lines.append('rm -f $state')
+    lines.append('touch $state')
+    lines.append(reindex_count_sh)
+    for name in backends:
+        backend = search_backends[name]
+        lines.append(reindex_job_sh % {
+            'name': name, 'clear': backend['clear'],
+            'remaining': backend['remaining'], 'batch_size': batch_size,
+            'index': backend['index'] % {'batch_size': batch_size}})
+    for i in range(0, len(backends), workers):
+        lines.append(' '.join(['{ reindex_%s || touch $state.failed; } &' %
+                               name for name in backends[i:i + workers]]) +
+                     ' wait')
+    lines.append('if [ -e $state.failed ]; then\n'
+                 '  echo "Reindexing stopped, run it again to resume"\n'
+                 '  rm -f $state.failed; exit 1\n'
+                 'fi\n'
+                 'rm -f $state')
+    return '\n'.join(lines)
+
+# Checks that a count of items left to index is a number.
+reindex_count_sh = """reindex_count() {
+  case "$1" in
+    ''|*[!0-9]*) echo "Could not count the items to index: $1"; return 1;;
+  esac
+}"""
+
+# Rebuilds one search index, see reindex_script().
+reindex_job_sh = """reindex_%(name)s() {
+  if grep -qx '%(name)s done' $state; then
+    echo '+ %(name)s is reindexed already'; return 0
+  fi
+  if ! grep -qx '%(name)s cleared' $state; then
+    (%(clear)s) > /dev/null || return 1
+    echo '%(name)s cleared' >> $state
+  fi
+  started=$(date +%%s)
+  left=$(%(remaining)s); reindex_count "$left" || return 1; first=$left
+  while [ "$left" -gt 0 ]; do
+    # Index the batches the count calls for before counting again, as every
+    # drush call bootstraps Drupal.
+    batches=$(((left + %(batch_size)d - 1) / %(batch_size)d)); i=0
+    while [ $i -lt $batches ]; do
+      %(index)s > /dev/null || return 1
+      i=$((i + 1))
+      echo "  %(name)s: batch $i of $batches"
+    done
+    now=$(%(remaining)s); reindex_count "$now" || return 1
+    if [ "$now" -ge "$left" ]; then
+      echo '%(name)s is not making progress'; return 1
+    fi
+    left=$now
+  done
+  took=$(($(date +%%s) - started))
+  echo '%(name)s done' >> $state
+  echo "+ %(name)s: $first documents in ${took}s," \\
+    "$((first / (took > 0 ? took : 1))) documents/s"
+}"""
+
+@task
+def batch(*commands):
+    """
+    Run several drush commands in one go, e.g. batch:updatedb,cc,cron
+
+    Commands are the names of the tasks of this module, or anything else to
+    pass to drush as is. They run in a single round trip to the host, each in
+    turn whether or not the ones before it failed, and are reported with
+    their outcome and duration.
+    """
+    if not commands:
+        abort('Give batch the drush commands to run')
+    with batched() as b:
+        for command in commands:
+            if command in _commands:
+                _drush(*(_commands[command] + (b,)))
+            else:
+                _drush(command, 'Running drush %s' % command, b)
+
+def _drush(cmd, label=None, batch=None):
+    """
+    Run drush `cmd`, or each of a list of commands in turn, from the live
+    site. Queued into `batch`, they run with --yes as there is no terminal
+    to answer prompts on; otherwise the operator answers them.
+    """
+    cmds = isinstance(cmd, list) and cmd or [cmd]
+    label = label or 'Running drush %s' % cmds[0]
+    if batch is None:
+        print('+ ' + label)
+        with cd('%s/current' % env.host_site_path):
+            with settings(hide('warnings'), warn_only=True):
+                run(' && '.join(['drush ' + c for c in cmds]))
+        return
+    batch.add(label, ' && '.join(['drush --yes ' + c for c in cmds]),
+              cwd='%s/current' % env.host_site_path, warn_only=True,
+              show=True, stage='drush %s' % cmds[0].split()[0])
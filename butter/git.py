@@ -1,31 +1,109 @@
 from __future__ import with_statement
-from fabric.api import env, cd, abort, hide
+from fabric.api import env, cd, abort, hide, settings
 from fabric.operations import run
+from butter.batch import batched
+from butter.host import link_changeset
+import re
+
+
+# Commits resolved so far, by the ref asked for.
+_resolved = {}
 
 
 def check_commit(ref):
+    """
+    Make sure the commit `ref` points to is in `private/repo`, and return it.
+
+    A commit hash that is already there needs no fetch. Otherwise only `ref`
+    is fetched from origin, or everything if origin does not know it by that
+    name. Once resolved, a ref keeps pointing to the same commit for the rest
+    of the run, so the other hosts of a push only need to have that commit.
+    """
     print('+ Ensuring %s exists in %s' % (ref, env.host_string))
+    commit = _resolved.get(ref)
     with cd('%s/private/repo' % env.host_site_path):
-        run('git fetch')
-        result = run('git rev-parse %s' % ref)
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            if commit is None and re.match(r'^[0-9a-f]{7,40}$', ref):
+                commit = _local_commit(ref)
+            elif commit is not None:
+                commit = _local_commit(commit) and commit
+            if commit:
+                _resolved[ref] = commit
+                return commit
+
+            result = run(fetch_sh(ref))
         if result.failed:
             abort('Commit %s doesnt exist' % ref)
-        else:
-            return result
+        if ref in _resolved:
+            # The ref may have moved on since, the commit must be there now.
+            if not _local_commit(_resolved[ref]):
+                abort('Commit %s doesnt exist' % _resolved[ref])
+            return _resolved[ref]
+        _resolved[ref] = result.strip()
+        return _resolved[ref]
 
 
-def checkout(parsed_ref):
-    print('+ Preparing %s for deployment' % parsed_ref)
-    with cd(env.host_site_path + '/private/repo'):
-        with hide('running', 'stdout'):
-            run("""git reset --hard %s && git submodule update --init \
-                    --recursive""" % parsed_ref)
-    with cd(env.host_site_path):
-        run("""mkdir changesets/%s && tar cf - private/repo \
+def fetch_sh(ref):
+    """
+    Returns a shell command that fetches `ref` from origin and prints the
+    commit it points to, run from a clone. Only `ref` is fetched, or
+    everything if origin does not know it by that name.
+    """
+    name = ref
+    if name.startswith('origin/'):
+        name = name[len('origin/'):]
+    return ('{ git fetch -q origin %s && git rev-parse FETCH_HEAD^{commit} || '
+            '{ git fetch -q && git rev-parse %s^{commit}; }; }' % (name, ref))
+
+
+def _local_commit(ref):
+    """
+    Returns the full hash of `ref` if it is a commit in the current repo
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        result = run('git rev-parse --verify -q %s^{commit}' % ref)
+    return result.succeeded and result.strip() or None
+
+
+def read_file(parsed_ref, path):
+    """
+    Returns the contents of `path` at `parsed_ref`, or None if it does not
+    exist.
+    """
+    with cd('%s/private/repo' % env.host_site_path):
+        with settings(hide('everything'), warn_only=True):
+            result = run('git show %s:%s' % (parsed_ref, path), pty=False)
+    if result.failed:
+        return None
+    # run() strips the trailing newline.
+    return result + '\n'
+
+
+def checkout(parsed_ref, batch=None):
+    """
+    Build changesets/<parsed_ref> from `private/repo`
+
+    With `env.changeset_mode = 'link'` the changeset is built with rsync,
+    hard-linking files that are unchanged from the live changeset instead of
+    copying the whole tree.
+    """
+    with batched(batch) as b:
+        b.add('Preparing %s for deployment' % parsed_ref,
+              """git reset --hard %s && git submodule update --init \
+                    --recursive""" % parsed_ref,
+              cwd=env.host_site_path + '/private/repo', stage='checkout')
+        if getattr(env, 'changeset_mode', 'copy') == 'link':
+            link_changeset('private/repo', parsed_ref, exclude="'/.git*'",
+                           batch=b)
+            return
+        b.add('Copying %s into changesets' % parsed_ref,
+              """mkdir changesets/%s && tar cf - private/repo \
                 | (cd changesets/%s; tar xpf -  --strip-components=2)"""
-                % (parsed_ref, parsed_ref))
-    with cd('%s/changesets/%s' % (env.host_site_path, parsed_ref)):
-        run('rm -rf .git*')
+                % (parsed_ref, parsed_ref), cwd=env.host_site_path,
+              stage='checkout')
+        b.add('Removing repository metadata', 'rm -rf .git*',
+              cwd='%s/changesets/%s' % (env.host_site_path, parsed_ref),
+              stage='checkout')
 
 
 def checkout_simple(parsed_ref):
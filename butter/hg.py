@@ -1,20 +1,95 @@
 from __future__ import with_statement
-from fabric.api import env, cd
+from fabric.api import env, cd, abort, hide, settings
 from fabric.operations import run
+from butter.batch import batched
+from butter.host import link_changeset
+import re
+
+# Changesets resolved so far, by the ref asked for.
+_resolved = {}
 
 def check_commit(ref):
+    """
+    Make sure the changeset `ref` points to is in `private/repo`, and return
+    its id.
+
+    A changeset hash that is already there needs no pull. Otherwise only
+    `ref` and its ancestors are pulled, or everything if the remote does not
+    know it by that name. Once resolved, a ref keeps pointing to the same
+    changeset for the rest of the run.
+    """
     print('+ Ensuring %s exists in %s' % (ref, env.host_string))
+    changeset = _resolved.get(ref)
     with cd('%s/private/repo' % env.host_site_path):
-        run('hg pull')
-        result = run('hg identify --id -r %s' % ref)
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            if changeset is None and re.match(r'^[0-9a-f]{12,40}$', ref):
+                changeset = _local_changeset(ref)
+            elif changeset is not None:
+                changeset = _local_changeset(changeset) and changeset
+            if changeset:
+                _resolved[ref] = changeset
+                return changeset
+
+            if run('hg pull -r %s' % ref).failed:
+                run('hg pull')
+            result = run('hg identify --id -r %s' % ref)
         if result.failed:
             abort('Commit %s doesnt exist' % ref)
-        else:
-            return result
-
-def checkout(parsed_ref):
-     print('+ Preparing %s for deployment' % parsed_ref)
-     with cd(env.host_site_path + '/private/repo'):
-         run('hg archive --rev %s ../../changesets/%s' % (parsed_ref, parsed_ref))
-     with cd('%s/changesets/%s' % (env.host_site_path, parsed_ref)):
-         run('rm -rf .hg*')
+        if ref in _resolved:
+            # The ref may have moved on since, the changeset must be there.
+            if not _local_changeset(_resolved[ref]):
+                abort('Commit %s doesnt exist' % _resolved[ref])
+            return _resolved[ref]
+        _resolved[ref] = result.strip()
+        return _resolved[ref]
+
+def _local_changeset(ref):
+    """
+    Returns the id of `ref` if it is a changeset in the current repo
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        result = run('hg identify --id -r %s' % ref)
+    return result.succeeded and result.strip() or None
+
+def read_file(parsed_ref, path):
+    """
+    Returns the contents of `path` at `parsed_ref`, or None if it does not
+    exist.
+    """
+    with cd('%s/private/repo' % env.host_site_path):
+        with settings(hide('everything'), warn_only=True):
+            result = run('hg cat -r %s %s' % (parsed_ref, path), pty=False)
+    if result.failed:
+        return None
+    # run() strips the trailing newline.
+    return result + '\n'
+
+def checkout(parsed_ref, batch=None):
+    """
+    Build changesets/<parsed_ref> from `private/repo`
+
+    With `env.changeset_mode = 'link'` the revision is archived to a staging
+    directory and the changeset is built from it with rsync, hard-linking
+    files that are unchanged from the live changeset.
+    """
+    with batched(batch) as b:
+        if getattr(env, 'changeset_mode', 'copy') == 'link':
+            archive = 'private/archive-%s' % parsed_ref
+            b.add('Preparing %s for deployment' % parsed_ref,
+                  'rm -rf %s && hg archive -R private/repo --rev %s %s'
+                  % (archive, parsed_ref, archive), cwd=env.host_site_path,
+                  stage='checkout')
+            # hg archive does not keep modification times, so compare
+            # contents instead.
+            link_changeset(archive, parsed_ref, exclude="'/.hg*'",
+                           checksum=True, batch=b)
+            b.add('Removing the staging archive', 'rm -rf %s' % archive,
+                  cwd=env.host_site_path, stage='checkout')
+            return
+        b.add('Preparing %s for deployment' % parsed_ref,
+              'hg archive --rev %s ../../changesets/%s' % (parsed_ref,
+                                                         parsed_ref),
+              cwd=env.host_site_path + '/private/repo', stage='checkout')
+        b.add('Removing repository metadata', 'rm -rf .hg*',
+              cwd='%s/changesets/%s' % (env.host_site_path, parsed_ref),
+              stage='checkout')
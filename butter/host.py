@@ -1,7 +1,199 @@
-from fabric.operations import run
-from fabric.contrib import files
+from __future__ import with_statement
+from time import time
+from pipes import quote
+from fabric.api import env, execute, parallel
+from fabric.network import normalize
+from butter.batch import batched
+from butter import profile
+import fabric.network
+import os
+import subprocess
 
-def pre_clean(build_path):
-    if files.exists(build_path):
-        print('+ Found the same revision already deployed. Cleaning up')
-        run('rm -rf %s' % build_path)
+def pre_clean(build_path, batch=None):
+    with batched(batch) as b:
+        b.add('Checking for a previous build of this revision',
+              'if [ -e %s ]; then '
+              'echo "Found the same revision already deployed. Cleaning up"; '
+              'rm -rf %s; fi' % (build_path, build_path), show=True,
+              stage='pre_clean')
+
+def link_changeset(src, parsed_ref, exclude, checksum=False, batch=None):
+    """
+    Copy the tree at `src` (relative to env.host_site_path) into the changeset
+    for `parsed_ref`, hard-linking every file that is unchanged from the live
+    changeset, so only the files that differ are written to disk.
+
+    Files get the 2770 mode set_perms would give them, so they compare equal
+    to their already deployed counterparts. Pass `checksum=True` when `src`
+    does not preserve modification times.
+    """
+    build_path = '%s/changesets/%s' % (env.host_site_path, parsed_ref)
+    options = '-rlpt --delete --chmod=D2770,F2770 --exclude=%s' % exclude
+    if checksum:
+        options += ' --checksum'
+    with batched(batch) as b:
+        b.add('Linking %s against the live changeset' % parsed_ref,
+              'previous=$(readlink current 2>/dev/null)\n'
+              'previous=${previous%%/public}\n'
+              'link_dest=""\n'
+              'if [ -n "$previous" ] && [ -d "$previous" ] '
+              '&& [ "$previous" != "%s" ]; then\n'
+              '  link_dest="--link-dest=$previous"\n'
+              'fi\n'
+              'mkdir -p %s && rsync %s $link_dest %s/ %s/'
+              % (build_path, build_path, options, src, build_path),
+              cwd=env.host_site_path, stage='checkout')
+
+def fan_out(func, args=(), hosts=None, pool_size=None):
+    """
+    Run `func(*args)` on every host at once, at most `pool_size` at a time.
+
+    Returns a dictionary of host => {'ok', 'result', 'error', 'duration'}. A
+    host that aborts does not stop the others, its failure is recorded in its
+    result instead.
+    """
+    def host_task():
+        start = time()
+        timed = len(profile.records)
+        try:
+            result = func(*args)
+        except (SystemExit, Exception) as e:
+            result = {'ok': False, 'result': None,
+                      'error': getattr(e, 'message', None) or str(e) or repr(e)}
+        else:
+            result = {'ok': True, 'result': result, 'error': None}
+        result['duration'] = time() - start
+        # Hosts run in forked processes, hand their timings back.
+        result['profile'] = profile.records[timed:]
+        return result
+
+    if pool_size:
+        pool_size = int(pool_size)
+    if profile.enabled():
+        # The hosts' timings are reported from this process, when fab exits.
+        profile._install()
+    results = execute(parallel(pool_size=pool_size)(host_task),
+                      hosts=hosts or env.hosts)
+    for host, result in results.items():
+        if not isinstance(result, dict):
+            results[host] = {'ok': False, 'result': None, 'duration': 0,
+                             'error': repr(result), 'profile': []}
+        elif result['profile']:
+            # Unless the host ran in this process after all.
+            last = result['profile'][-1]
+            if not [record for record in profile.records if record is last]:
+                profile.records.extend(result['profile'])
+    return results
+
+def failed_hosts(results):
+    return sorted([host for host in results if not results[host]['ok']])
+
+def report(results):
+    """
+    Print the outcome and duration of a fan_out() run, one line per host.
+    """
+    for host in sorted(results):
+        result = results[host]
+        if result['ok']:
+            print('  %-40s ok     %7.1fs' % (host, result['duration']))
+        else:
+            print('  %-40s FAILED %7.1fs  %s' % (host, result['duration'],
+                                                 result['error']))
+
+def ssh_command(host, command, local=True):
+    """
+    Build an OpenSSH command line that runs `command` on `host`.
+
+    With `local=True` the command is meant to run on this machine, and uses
+    the keys and gateway Fabric is configured with. Otherwise it is meant to
+    run on another host and only sets the user and port.
+    """
+    user, hostname, port = normalize(host)
+    options = ssh_options(local) + ['-p %s' % port]
+    return 'ssh %s %s@%s %s' % (' '.join(options), user, hostname,
+                                quote(command))
+
+def ssh_options(local=True, gateway=True):
+    """
+    OpenSSH options for ssh_command().
+
+    Unless `env.ssh_multiplex` is 'no', every command run from this machine to
+    a host shares one connection, which stays open for `env.ssh_persist` (60
+    seconds by default) after the last command so the next fab run can reuse
+    it too. The connection to `env.gateway` is shared the same way, and
+    Fabric's own connections to the hosts behind it go through it as well.
+    """
+    options = ['-o BatchMode=yes']
+    if local:
+        options.extend(_multiplex_options())
+        keys = env.key_filename or []
+        if not isinstance(keys, (list, tuple)):
+            keys = [keys]
+        options.extend(['-i %s' % key for key in keys])
+        if env.gateway and gateway:
+            # %% escapes the tokens ssh would expand in the ProxyCommand.
+            proxy = ['ssh'] + [option.replace('%', '%%') for option in
+                               _multiplex_options()] + \
+                ['-W %h:%p', _gateway_target()]
+            options.append('-o ProxyCommand=%s' % quote(' '.join(proxy)))
+    return options
+
+def ssh_master(host):
+    """
+    Open the shared connection to `host` ahead of running several commands on
+    it at once, so they don't race to open their own. Returns True if it is
+    open, whether it was already or has just been opened.
+    """
+    if getattr(env, 'ssh_multiplex', 'yes') == 'no':
+        return False
+    user, hostname, port = normalize(host)
+    # The gateway is not reached through itself.
+    options = ssh_options(gateway=not env.gateway or
+                          normalize(env.gateway) != (user, hostname, port))
+    target = ' '.join(options + ['-p %s' % port, '%s@%s' % (user, hostname)])
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call('ssh -O check %s' % target, shell=True,
+                           stdout=devnull, stderr=devnull) == 0:
+            profile.connection(host, opened=False)
+            return True
+        start = time()
+        status = subprocess.call('ssh %s true' % target, shell=True,
+                                 stdout=devnull, stderr=devnull)
+    profile.connection(host, opened=True, duration=time() - start)
+    return status == 0
+
+def _gateway_target():
+    """
+    The gateway as OpenSSH takes it, with its port as an option
+    """
+    user, hostname, port = normalize(env.gateway)
+    return '-p %s %s@%s' % (port, user, hostname)
+
+def _gateway_socket(host, port, cache, replace=False):
+    """
+    Stands in for fabric.network.get_gateway. Unless `env.ssh_multiplex` is
+    'no', Fabric reaches the hosts behind `env.gateway` through the shared
+    OpenSSH connection to the gateway instead of its own, so a fab run
+    started within `env.ssh_persist` seconds of the previous one does not
+    connect and authenticate to the gateway again.
+
+    OpenSSH runs in batch mode, so a gateway it can't log in to on its own,
+    e.g. one that wants a password or has an unknown host key, is reached
+    by Fabric itself as before.
+    """
+    if not env.gateway or getattr(env, 'ssh_multiplex', 'yes') == 'no' or \
+            not ssh_master(env.gateway):
+        return _get_gateway(host, port, cache, replace)
+    from paramiko import ProxyCommand
+    return ProxyCommand('ssh %s -W %s:%s %s' % (
+        ' '.join(ssh_options(gateway=False)), host, port, _gateway_target()))
+
+_get_gateway = fabric.network.get_gateway
+fabric.network.get_gateway = _gateway_socket
+
+def _multiplex_options():
+    if getattr(env, 'ssh_multiplex', 'yes') == 'no':
+        return []
+    return ['-o ControlMaster=auto',
+            '-o ControlPath=~/.ssh/butter-%r@%h:%p',
+            '-o ControlPersist=%s' % getattr(env, 'ssh_persist', 60)]
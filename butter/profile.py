@@ -0,0 +1,205 @@
+"""
+Per-host timing of butter's stages, of the remote round trips they make, and
+of the SSH connections opened and reused along the way.
+
+Profiling is off unless `env.profile` or `env.profile_output` is set, e.g.
+`fab --set profile=1 ...`. A summary table is printed when fab exits. With
+`env.profile_output` the timings are also written, as JSON lines
+(`env.profile_format = 'json'`, the default for files) or in statsd format
+(`'statsd'`, the default for sockets), to a file or to a `udp://host:port` or
+`tcp://host:port` socket.
+"""
+from __future__ import with_statement
+from contextlib import contextmanager
+from fabric.api import env
+from time import time
+import atexit
+import fabric.network
+import fabric.operations
+import fabric.sftp
+import json
+import re
+import socket
+
+# Timed stages: dictionaries of host, stage, duration and round_trips.
+records = []
+
+# Stages being timed, innermost last.
+_open = []
+
+_installed = []
+
+def enabled():
+    return bool(getattr(env, 'profile', None) or
+                getattr(env, 'profile_output', None))
+
+@contextmanager
+def stage(name):
+    """
+    Time the block as stage `name` of the current host. Remote commands and
+    transfers in the block count as round trips of the innermost stage.
+    """
+    if not enabled():
+        yield
+        return
+    _install()
+    record = {'host': env.host_string, 'stage': name, 'round_trips': 0}
+    _open.append(record)
+    started = time()
+    try:
+        yield
+    finally:
+        _open.remove(record)
+        record['duration'] = time() - started
+        records.append(record)
+
+def add(name, duration, round_trips=0):
+    """
+    Record a stage timed elsewhere, e.g. on the host.
+    """
+    if enabled():
+        _install()
+        records.append({'host': env.host_string, 'stage': name,
+                        'duration': duration, 'round_trips': round_trips})
+
+def add_steps(results):
+    """
+    Record the steps run by a Batch, by stage
+    """
+    for result in results:
+        if result['duration'] is not None:
+            add(result['stage'], result['duration'])
+
+def connection(host, opened, duration=0):
+    """
+    Record that a connection to `host` was opened (a miss), taking `duration`
+    seconds, or that an open one was reused (a hit).
+    """
+    if enabled():
+        _install()
+        records.append({'host': host, 'round_trips': 0, 'duration': duration,
+                        'stage': opened and 'ssh_connect' or 'ssh_reuse'})
+
+def summary():
+    """
+    Print the number of runs, time and round trips of every stage, by host
+    """
+    totals = {}
+    order = []
+    for record in records:
+        key = (record['host'], record['stage'])
+        if key not in totals:
+            totals[key] = [0, 0.0, 0]
+            order.append(key)
+        totals[key][0] += 1
+        totals[key][1] += record['duration']
+        totals[key][2] += record['round_trips']
+    print('+ Stage timings')
+    # Connections are reported on their own.
+    connections = {}
+    for key in list(order):
+        if key[1] in ('ssh_connect', 'ssh_reuse'):
+            order.remove(key)
+            connections.setdefault(key[0], {'ssh_connect': 0,
+                                            'ssh_reuse': 0})
+            connections[key[0]][key[1]] = totals[key][0]
+    print('  %-30s %-30s %5s %9s %11s' % ('host', 'stage', 'runs', 'seconds',
+                                         'round trips'))
+    for key in order:
+        print('  %-30s %-30s %5d %9.2f %11d' % (key + tuple(totals[key])))
+    if connections:
+        print('+ SSH connections')
+        print('  %-30s %7s %7s' % ('host', 'opened', 'reused'))
+        for host in sorted(connections):
+            print('  %-30s %7d %7d' % (host, connections[host]['ssh_connect'],
+                                       connections[host]['ssh_reuse']))
+
+def export(output, format=None):
+    """
+    Write the records to `output`, a file path or a udp:// or tcp:// address
+    """
+    match = re.match(r'^(udp|tcp)://([^:]+):(\d+)$', output)
+    if format is None:
+        format = match and 'statsd' or 'json'
+    if format == 'statsd':
+        prefix = getattr(env, 'profile_prefix', 'butter')
+        lines = []
+        for record in records:
+            name = '.'.join([_statsd_name(part) for part in
+                             (prefix, record['stage'], record['host'])])
+            lines.append('%s.duration:%d|ms' % (name,
+                                                record['duration'] * 1000))
+            lines.append('%s.round_trips:%d|c' % (name, record['round_trips']))
+    else:
+        lines = [json.dumps(record, sort_keys=True) for record in records]
+
+    if not match:
+        with open(output, 'a') as out:
+            out.write(''.join([line + '\n' for line in lines]))
+    elif match.group(1) == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for line in lines:
+            sock.sendto(line.encode('utf-8'),
+                        (match.group(2), int(match.group(3))))
+        sock.close()
+    else:
+        sock = socket.create_connection((match.group(2), int(match.group(3))))
+        sock.sendall(''.join([line + '\n' for line in lines]).encode('utf-8'))
+        sock.close()
+
+def _statsd_name(value):
+    return re.sub(r'[^\w-]+', '_', str(value)).strip('_')
+
+def _count():
+    if _open:
+        _open[-1]['round_trips'] += 1
+
+def _install():
+    """
+    Start counting round trips, and report when fab exits. This only happens
+    once profiling is actually used.
+    """
+    if _installed:
+        return
+    _installed.append(True)
+
+    run_command = fabric.operations._run_command
+    def counted_run_command(*args, **kwargs):
+        _count()
+        return run_command(*args, **kwargs)
+    fabric.operations._run_command = counted_run_command
+
+    for name in ('put', 'get'):
+        def counted_transfer(self, *args, **kwargs):
+            _count()
+            return counted_transfer.transfer(self, *args, **kwargs)
+        counted_transfer.transfer = getattr(fabric.sftp.SFTP, name)
+        setattr(fabric.sftp.SFTP, name, counted_transfer)
+
+    cache = fabric.network.HostConnectionCache
+    connect = cache.connect
+    def counted_connect(self, key):
+        start = time()
+        try:
+            return connect(self, key)
+        finally:
+            connection(key, opened=True, duration=time() - start)
+    cache.connect = counted_connect
+
+    getitem = cache.__getitem__
+    def counted_getitem(self, key):
+        if fabric.network.join_host_strings(*fabric.network.normalize(key)) \
+                in self:
+            connection(key, opened=False)
+        return getitem(self, key)
+    cache.__getitem__ = counted_getitem
+
+    atexit.register(_finish)
+
+def _finish():
+    if not records:
+        return
+    summary()
+    output = getattr(env, 'profile_output', None)
+    if output:
+        export(output, getattr(env, 'profile_format', None))
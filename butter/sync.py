@@ -1,45 +1,209 @@
-from fabric.api import task, env, execute, settings
+from fabric.api import task, env, execute, settings, hide
 from fabric.operations import run, local, prompt
-from fabric.utils import abort
-from copy import copy, deepcopy
+from fabric.utils import abort, _AttributeDict
+from butter.host import ssh_command, ssh_master
+from copy import copy
+from fnmatch import fnmatchcase
+from multiprocessing.pool import ThreadPool
+from pipes import quote
+from subprocess import Popen, PIPE
+from time import time
+import json
+import os
+import re
+
+# Drops every table of a database.
+drop_tables_sql = """mysql -h %(db_host)s -u%(db_user)s -p%(db_pw)s -BNe "show tables" %(db_db)s \
+    | tr '\n' ',' | sed -e 's/,$//' \
+    | awk '{print "SET FOREIGN_KEY_CHECKS = 0;DROP TABLE IF EXISTS " $1 ";SET FOREIGN_KEY_CHECKS = 1;"}' \
+    | mysql -h %(db_host)s -u%(db_user)s -p%(db_pw)s %(db_db)s"""
+
+# Glob patterns of tables that sync.db copies as structure only or skips,
+# by profile name. See drupal.py for an example.
+profiles = {}
+
+# Lists the tables of a database with their size in bytes.
+table_sizes_sql = """SELECT table_name, data_length + index_length
+    FROM information_schema.tables WHERE table_schema = '%(db_db)s'"""
 
 @task
-def files(dst='local', opts_string=''):
+def files(dst='local', opts_string='', engine=None, jobs=8, full='no'):
     """
     Syncs files from the environment's S3 bucket to `dst` env.files_path.
+
+    With `engine=sharded` (or `env.files_sync_engine = 'sharded'`) the bucket
+    is synced one top-level prefix at a time, `jobs` at once, and prefixes
+    whose objects did not change since the last sync are skipped, unless
+    `full=yes` is given.
     """
     if dst == 'production':
         abort('Cannot sync to production.')
     if not 's3_bucket' in env:
         abort('Please configure an env.s3_bucket for this project.')
 
-    execute(dst)
-    dst_env = copy(env)
+    dst_env = _get_env(dst)
 
     opts_string += ' --region=us-west-2'
 
-    if not 'files_path' in dst_env:
+    # files_path may have been defaulted after dst was first resolved.
+    files_path = getattr(dst_env, 'files_path', getattr(env, 'files_path',
+                                                        None))
+    if not files_path:
         abort('`files_path` not found in dst env.')
 
     if dst == 'local':
         # Ensure drupal.sync works anywhere in project structure by getting the
         # directory that the fabfile is in (project root).
-        import os
-        dst_files = os.path.dirname(env.real_fabfile) + '/' + dst_env.files_path
-        local('aws s3 sync %s %s %s' % (env.s3_bucket,
+        dst_files = os.path.dirname(env.real_fabfile) + '/' + files_path
+        host = None
+    else:
+        dst_files = '%s/%s' % (dst_env.host_site_path, files_path)
+        host = dst_env.hosts[0]
+
+    if (engine or getattr(env, 'files_sync_engine', None)) == 'sharded':
+        _sharded_files(dst_env.s3_bucket, dst_files, opts_string, host,
+                       int(jobs), full == 'yes')
+    elif host is None:
+        local('aws s3 sync %s %s %s' % (dst_env.s3_bucket,
             dst_files, opts_string));
     else:
-        with settings(host_string=dst_env.hosts[0]):
-            dst_files = '%s/%s' % (dst_env.host_site_path, dst_env.files_path)
-            run('aws s3 sync %s %s %s' % (env.s3_bucket,
+        with settings(host_string=host):
+            run('aws s3 sync %s %s %s' % (dst_env.s3_bucket,
                 dst_files, opts_string));
 
-    print('+ Files synced to %s' % dst_env.files_path)
+    print('+ Files synced to %s' % files_path)
+
+def _sharded_files(bucket, dst_files, opts_string, host, jobs, full):
+    """
+    Syncs `bucket` to `dst_files`, on `host` or here, one top-level prefix at
+    a time, `jobs` at once.
+
+    A prefix is skipped when it is at the destination and a listing of the
+    ETags and sizes of its objects hashes the same as at its last successful
+    sync, as kept in a manifest next to the synced files, in
+    `dst_files`/.butter-s3sync. Prefixes matching an --exclude of
+    `opts_string` are not listed at all. Objects at the top of the bucket
+    are always synced.
+    """
+    shell = lambda command: host and ssh_command(host, command) or command
+    region = re.search(r'--region[= ](\S+)', opts_string)
+    region = region and ' --region=%s' % region.group(1) or ''
+    excludes = re.findall(r"--exclude[= ]'([^']*)'", opts_string)
+    bucket = bucket.rstrip('/') + '/'
+    bucket_name, _, root = bucket[len('s3://'):].partition('/')
+
+    manifest_path = dst_files + '/.butter-s3sync'
+    manifest = {}
+    if not full:
+        status, out = _capture(shell('cat %s 2>/dev/null' %
+                                     quote(manifest_path)))
+        try:
+            manifest = status == 0 and json.loads(out) or {}
+        except ValueError:
+            print('+ Ignoring the unreadable manifest %s' % manifest_path)
+
+    status, listing = _capture(shell('aws s3 ls %s%s' % (bucket, region)))
+    if status != 0:
+        abort('Could not list %s' % bucket)
+    prefixes = [line.split(' PRE ', 1)[1] for line in listing.splitlines()
+                if ' PRE ' in line]
+    prefixes = [prefix for prefix in prefixes if not
+                [pattern for pattern in excludes
+                 if fnmatchcase(prefix, pattern)]]
+
+    def sync(prefix):
+        start = time()
+        # A failed listing gives no fingerprint, so the prefix gets synced
+        # and nothing is recorded. One missing at the destination is synced
+        # whatever its fingerprint.
+        status, out = _capture(shell(
+            "listing=$(aws s3api list-objects-v2 --bucket %s --prefix %s "
+            "--query 'Contents[].[Key,ETag,Size]' --output text%s) && "
+            "echo \"$listing\" | sha1sum && { [ -d %s ] && echo present; "
+            "true; }" % (bucket_name, quote(root + prefix), region,
+                         quote(dst_files + '/' + prefix))))
+        fingerprint = status == 0 and out.split() and out.split()[0] or None
+        if fingerprint and 'present' in out.split() and \
+                manifest.get(prefix) == fingerprint:
+            return prefix, None, fingerprint, time() - start
+        status, out = _capture(shell('aws s3 sync %s %s %s' % (
+            quote(bucket + prefix), quote(dst_files + '/' + prefix),
+            opts_string)))
+        return prefix, status, fingerprint, time() - start
+
+    print('+ Syncing %d prefixes of %s to %s, %d at a time' %
+          (len(prefixes), bucket, dst_files, jobs))
+    start = time()
+    synced = {}
+    done = []
+    unchanged = 0
+    failed = []
+    pool = ThreadPool(jobs)
+    for prefix, status, fingerprint, duration in \
+            pool.imap_unordered(sync, prefixes):
+        if status is None:
+            outcome = 'unchanged'
+            unchanged += 1
+        elif status == 0:
+            outcome = 'synced'
+        else:
+            outcome = 'FAILED with status %s' % status
+            failed.append(prefix)
+        if status is None or status == 0:
+            done.append(prefix)
+            if fingerprint:
+                synced[prefix] = fingerprint
+        print('+ [%d/%d] %s %s in %.1fs' % (len(done) + len(failed),
+                                            len(prefixes), prefix, outcome,
+                                            duration))
+    pool.close()
+    pool.join()
+
+    # Objects at the top of the bucket, outside of any prefix.
+    status, out = _capture(shell(
+        "aws s3 sync %s %s %s --exclude '*/*' --exclude .butter-s3sync" % (
+            bucket, quote(dst_files), opts_string)))
+    if status != 0:
+        failed.append('/')
+
+    status, out = _capture(shell('cat > %s.tmp && mv %s.tmp %s' % (
+        (quote(manifest_path),) * 3)), json.dumps(synced, indent=1,
+                                                  sort_keys=True))
+    if status != 0:
+        print('+ Could not save the manifest %s' % manifest_path)
+    print('+ %d prefixes synced, %d unchanged in %.1fs' % (
+        len(done) - unchanged, unchanged, time() - start))
+    if failed:
+        abort('Could not sync %s' % ', '.join(failed))
+
+def _capture(command, input=None):
+    """
+    Runs `command` here, with `input` on its stdin, and returns its exit
+    status and output.
+    """
+    process = Popen(command, shell=True, stdin=input is not None and PIPE or
+                    None, stdout=PIPE)
+    out = process.communicate(input is not None and input.encode('utf-8') or
+                              None)[0].decode('utf-8', 'replace')
+    return process.returncode, out
 
 @task
-def db(src, dst):
+def db(src, dst, engine=None, jobs=4, incremental='no', profile=None):
     """
     Copies a database from `src` to `dst` environment.
+
+    The default `local` engine pipes mysqldump into mysql on this machine.
+    The `stream` engine (or `env.db_sync_engine = 'stream'`) dumps on the
+    source host, compresses, and loads `jobs` tables at a time on the
+    destination host.
+
+    With `incremental=yes` only the tables whose CHECKSUM TABLE differs
+    between `src` and `dst` are reloaded, and tables missing from `src` are
+    dropped from `dst`.
+
+    `profile` names an entry of `profiles` (or of `env.db_sync_profiles`)
+    listing glob patterns of tables to copy as structure only, or to skip and
+    leave untouched in `dst`.
     """
     if src == 'local':
         abort('Cannot sync from local.')
@@ -48,30 +212,286 @@ def db(src, dst):
       if force_push == 'n':
         abort('Sync aborted')
 
+    profile = _profile(profile)
+    if (engine or getattr(env, 'db_sync_engine', 'local')) == 'stream':
+        _stream_db(src, dst, int(jobs), incremental == 'yes', profile)
+        print('+ Database synced from %s to %s' % (src, dst))
+        return
+
     # record the environments
     dst_env = _get_env(dst)
     src_env = _get_env(src)
 
-    dst_env.db_host = _mysql_db_host(dst)
-    src_env.db_host = _mysql_db_host(src)
+    dst_db_host = _mysql_db_host(dst)
+    src_db_host = _mysql_db_host(src)
 
-    # Drop the previous tables in dst in case it has tables not in src.
-    drop_tables_sql = """mysql -h %(db_host)s -u%(db_user)s -p%(db_pw)s -BNe "show tables" %(db_db)s \
-        | tr '\n' ',' | sed -e 's/,$//' \
-        | awk '{print "SET FOREIGN_KEY_CHECKS = 0;DROP TABLE IF EXISTS " $1 ";SET FOREIGN_KEY_CHECKS = 1;"}' \
-        | mysql -h %(db_host)s -u%(db_user)s -p%(db_pw)s %(db_db)s"""
+    dump_sql = 'mysqldump -h %s -u%s -p%s %s' % (src_db_host,
+            src_env.db_user, src_env.db_pw, src_env.db_db)
+    import_sql = 'mysql -h %s -u%s -p%s -D%s' % (dst_db_host,
+            dst_env.db_user, dst_env.db_pw, dst_env.db_db)
+
+    if incremental == 'yes' or profile:
+        tables, structure_only, sizes = _plan_tables(
+            _db_endpoint(src, remote=False), _db_endpoint(dst, remote=False),
+            incremental == 'yes', profile)
+        if tables:
+            local('%s %s | %s' % (dump_sql, ' '.join(tables), import_sql))
+        if structure_only:
+            local('%s --no-data %s | %s' % (dump_sql, ' '.join(structure_only),
+                                           import_sql))
+        print('+ Database synced from %s to %s' % (src, dst))
+        return
 
-    local(drop_tables_sql % {"db_host": dst_env.db_host,
+    # Drop the previous tables in dst in case it has tables not in src.
+    local(drop_tables_sql % {"db_host": dst_db_host,
         "db_user": dst_env.db_user, "db_pw": dst_env.db_pw,
         "db_db": dst_env.db_db})
 
-    dump_sql = 'mysqldump -h %s -u%s -p%s %s' % (src_env.db_host,
-            src_env.db_user, src_env.db_pw, src_env.db_db)
-    import_sql = 'mysql -h %s -u%s -p%s -D%s' % (dst_env.db_host,
-            dst_env.db_user, dst_env.db_pw, dst_env.db_db)
     local('%s | %s' % (dump_sql, import_sql))
     print('+ Database synced from %s to %s' % (src, dst))
 
+def _stream_db(src, dst, jobs, incremental=False, profile=None):
+    """
+    Streams every table from `src` to `dst`, `jobs` tables at a time, or
+    only the changed ones if `incremental`.
+
+    Each table is dumped on the source host and compressed there. Its stream
+    is relayed through this machine to the destination host, or, with
+    `env.db_sync_direct`, piped straight from the source host to the
+    destination host (this needs ssh access between them, e.g. with
+    `env.forward_agent`). Tables are dumped in separate transactions, so the
+    copy is not a consistent snapshot of a database that is being written to.
+    """
+    src_db = _db_endpoint(src)
+    dst_db = _db_endpoint(dst)
+    direct = getattr(env, 'db_sync_direct', False) and src_db.ssh_host and \
+        dst_db.ssh_host
+
+    tables, structure_only, sizes = _plan_tables(src_db, dst_db, incremental,
+                                                 profile)
+    jobs_list = [(table, False) for table in tables] + \
+        [(table, True) for table in structure_only]
+    if not jobs_list:
+        return
+    total_size = sum([sizes[table] for table in tables])
+    # Share one connection per host between the jobs.
+    for endpoint in (src_db, dst_db):
+        if endpoint.ssh_host:
+            ssh_master(endpoint.ssh_host)
+
+    print('+ Streaming %d tables (%s of data) from %s to %s, %d at a time' %
+          (len(jobs_list), _mb(total_size), src, dst, jobs))
+    start = time()
+    done = []
+    failed = []
+    pool = ThreadPool(jobs)
+    stream = lambda job: _stream_table(src_db, dst_db, job[0], direct, job[1])
+    for table, status, transferred, duration in \
+            pool.imap_unordered(stream, jobs_list):
+        done.append(transferred)
+        if status != 0:
+            failed.append(table)
+        print('+ [%d/%d] %s: %s compressed in %.1fs (%s/s)%s' % (
+            len(done), len(jobs_list), table, _mb(transferred), duration,
+            _mb(transferred / max(duration, 0.001)),
+            status and ' FAILED with status %s' % status or ''))
+    pool.close()
+    pool.join()
+
+    elapsed = time() - start
+    print('+ Transferred %s in %.1fs (%s/s)' % (_mb(sum(done)), elapsed,
+                                               _mb(sum(done) / elapsed)))
+    if failed:
+        abort('Could not sync tables: %s' % ', '.join(failed))
+
+def _plan_tables(src_db, dst_db, incremental, profile):
+    """
+    Works out which tables to copy and prepares `dst_db` to receive them.
+
+    Returns the tables to copy with their data, largest first, the tables to
+    copy as structure only, and the size in bytes of every table in `src_db`.
+    Every table of `dst_db` is dropped, except the ones the profile skips,
+    or, if `incremental`, only the ones that are no longer in `src_db`.
+    """
+    # Views have no size, mysql prints NULL for them.
+    sizes = dict([(table, size.isdigit() and int(size) or 0)
+                  for table, size in _db_query(src_db, table_sizes_sql %
+                                               src_db)])
+    tables = sorted(sizes, key=lambda table: -sizes[table])
+    structure_only = []
+    skip = []
+    if profile:
+        structure_only = _match_tables(tables,
+                                       profile.get('structure_only', []))
+        skip = _match_tables(tables, profile.get('skip', []))
+        structure_only = [table for table in structure_only
+                          if table not in skip]
+        tables = [table for table in tables
+                  if table not in structure_only and table not in skip]
+        print('+ Copying %d tables as structure only and skipping %d, '
+              'saving %s' % (len(structure_only), len(skip), _mb(sum(
+                  [sizes[table] for table in structure_only + skip]))))
+
+    dst_tables = [row[0] for row in _db_query(dst_db, 'SHOW TABLES')]
+    if incremental:
+        stale = [table for table in dst_tables if table not in sizes]
+        # mysqldump drops and recreates each table it loads.
+        tables = _changed_tables(src_db, dst_db,
+                                 [table for table in tables
+                                  if table in dst_tables]) + \
+            [table for table in tables if table not in dst_tables]
+    else:
+        stale = [table for table in dst_tables if table not in skip]
+    if stale:
+        print('+ Dropping %d tables in %s' % (len(stale), dst_db.name))
+        _db_query(dst_db, 'SET FOREIGN_KEY_CHECKS = 0; DROP TABLE IF EXISTS '
+                  '%s; SET FOREIGN_KEY_CHECKS = 1;' % ', '.join(
+                      ['`%s`' % table for table in stale]))
+    return tables, structure_only, sizes
+
+def _profile(profile):
+    """
+    Looks up a table profile by name. Returns None for no profile.
+    """
+    if not profile or profile == 'none':
+        return None
+    if isinstance(profile, dict):
+        return profile
+    available = dict(profiles)
+    available.update(getattr(env, 'db_sync_profiles', {}))
+    if profile not in available:
+        abort('Unknown table profile %s. Available profiles: %s' %
+              (profile, ', '.join(sorted(available))))
+    return available[profile]
+
+def _match_tables(tables, patterns):
+    return [table for table in tables
+            if [pattern for pattern in patterns
+                if fnmatchcase(table, pattern)]]
+
+def _stream_table(src_db, dst_db, table, direct, no_data=False):
+    """
+    Copies one table, and returns (table, status, bytes, seconds).
+    """
+    dump = ('mysqldump --single-transaction --quick -h %(db_host)s '
+            '-u%(db_user)s -p%(db_pw)s %(db_db)s ' % src_db) + table + \
+        ' | gzip -1'
+    if no_data:
+        dump = dump.replace('mysqldump ', 'mysqldump --no-data ', 1)
+    load = 'gunzip | mysql -h %(db_host)s -u%(db_user)s -p%(db_pw)s ' \
+        '-D%(db_db)s' % dst_db
+    start = time()
+    if direct:
+        # dd reports how many bytes went through it on stderr.
+        command = _pipefail('%s | dd bs=65536 | %s' % (
+            dump, ssh_command(dst_db.ssh_host, load, local=False)))
+        process = Popen(_db_shell(src_db, command), shell=True, stderr=PIPE)
+        out, err = process.communicate()
+        match = re.search(r'(\d+) bytes', err.decode('utf-8', 'replace'))
+        transferred = match and int(match.group(1)) or 0
+        status = process.returncode
+    else:
+        dumper = Popen(_db_shell(src_db, _pipefail(dump)), shell=True,
+                       stdout=PIPE)
+        loader = Popen(_db_shell(dst_db, load), shell=True, stdin=PIPE)
+        transferred = 0
+        try:
+            while True:
+                chunk = dumper.stdout.read(65536)
+                if not chunk:
+                    break
+                loader.stdin.write(chunk)
+                transferred += len(chunk)
+        except (IOError, OSError):
+            # The loader went away, its exit status tells why.
+            dumper.kill()
+        try:
+            loader.stdin.close()
+        except (IOError, OSError):
+            pass
+        # Both have to succeed: an empty dump loads cleanly too.
+        loaded = loader.wait()
+        dumped = dumper.wait()
+        status = loaded or dumped
+    return table, status, transferred, time() - start
+
+def _pipefail(command):
+    """
+    Wraps the pipeline `command` so that it fails if any of its commands
+    does, e.g. a mysqldump piped into gzip.
+    """
+    return 'bash -o pipefail -c %s' % quote(command)
+
+def _changed_tables(src_db, dst_db, tables):
+    """
+    Returns the `tables` whose checksum differs between `src_db` and
+    `dst_db`.
+    """
+    print('+ Comparing table checksums of %s and %s' % (src_db.name,
+                                                       dst_db.name))
+    pool = ThreadPool(2)
+    src_sums, dst_sums = pool.map(lambda db: _checksums(db, tables),
+                                  [src_db, dst_db])
+    pool.close()
+    # Views and tables that could not be checksummed are always copied.
+    changed = [table for table in tables if src_sums.get(table) in
+               (None, 'NULL') or src_sums[table] != dst_sums.get(table)]
+    print('+ %d of %d tables changed' % (len(changed), len(tables)))
+    return changed
+
+def _checksums(endpoint, tables):
+    """
+    Returns a dictionary of table => CHECKSUM TABLE result.
+    """
+    if not tables:
+        return {}
+    rows = _db_query(endpoint, 'CHECKSUM TABLE %s' % ', '.join(
+        ['`%s`' % table for table in tables]))
+    # Tables are reported as `database.table`.
+    return dict([(row[0].split('.', 1)[-1], row[-1]) for row in rows])
+
+def _db_endpoint(env_name, remote=True):
+    """
+    Where and how to reach the database of `env_name`.
+
+    Commands for an environment with hosts run on its first host, which
+    connects to the database host resolved by _mysql_db_host() as it sees it.
+    With `remote=False` they run on this machine.
+    """
+    local_env = _get_env(env_name)
+    hosts = getattr(local_env, 'hosts', [])
+    db_host = _mysql_db_host(env_name)
+    ssh_host = None
+    if remote and len(hosts):
+        ssh_host = hosts[0]
+        if db_host == hosts[0]:
+            db_host = 'localhost'
+    return _AttributeDict({'name': env_name, 'ssh_host': ssh_host,
+                           'db_host': db_host, 'db_user': local_env.db_user,
+                           'db_pw': local_env.db_pw,
+                           'db_db': local_env.db_db})
+
+def _db_shell(endpoint, command):
+    """
+    Wraps `command` to run where the database of `endpoint` is reachable.
+    """
+    if endpoint.ssh_host:
+        return ssh_command(endpoint.ssh_host, command)
+    return command
+
+def _db_query(endpoint, sql):
+    """
+    Runs `sql` against the database of `endpoint` and returns its rows.
+    """
+    command = 'mysql -h %(db_host)s -u%(db_user)s -p%(db_pw)s -BN ' % endpoint
+    command += '-e %s %s' % (quote(sql), endpoint.db_db)
+    with hide('running'):
+        out = local(_db_shell(endpoint, command), capture=True)
+    return [tuple(line.split('\t')) for line in out.splitlines() if line]
+
+def _mb(size):
+    return '%.1f MB' % (size / 1048576.0)
+
 def _mysql_db_host(env_name):
     """
     Figures out the correct host to use for database moving calls.
@@ -83,22 +503,44 @@ def _mysql_db_host(env_name):
         db_host = hosts[0]
     return db_host
 
+class _Snapshot(_AttributeDict):
+    """
+    A read-only env, as an environment task left it.
+    """
+    def __setitem__(self, key, value):
+        raise TypeError('Environment snapshots are read-only, cannot set %s'
+                        % key)
+
+    def __delitem__(self, key):
+        raise TypeError('Environment snapshots are read-only, cannot delete '
+                        '%s' % key)
+
+    __setattr__ = __setitem__
+
+# Environments resolved by _get_env(), by name.
+_envs = {}
+
 def _get_env(env_name):
     """
     Returns an env object for env_name without overwriting the global env.
-    """
-    global env
-    previous = deepcopy(env)
-    execute(env_name)
-    local_env = deepcopy(env)
 
-    # Delete any attributes that were added.
-    for key, value in local_env.iteritems():
-        if not key in previous:
-            del env[key]
+    The environment task only runs the first time a name is resolved, every
+    call returns the same read-only snapshot.
+    """
+    if env_name not in _envs:
+        # Only the top level, and the containers on it that a task could
+        # change in place, are copied to restore env afterwards.
+        previous = dict([(key, copy(value) if isinstance(
+                              value, (dict, list, set)) else value)
+                         for key, value in env.items()])
+        execute(env_name)
+        _envs[env_name] = _Snapshot(env)
 
-    # Put the original values back on env.
-    for key, value in previous.iteritems():
-        env[key] = value
+        # Delete any attributes that were added.
+        for key in list(env.keys()):
+            if not key in previous:
+                del env[key]
 
-    return local_env
+        # Put the original values back on env.
+        env.update(previous)
+    return _envs[env_name]